@@ -0,0 +1,142 @@
+"""
+Group broadcast latency and throughput, by channel layer.
+
+One page group of ``--members`` consumers' channels; ``--events`` pre-encoded
+comment events are sent to it, first one at a time (latency: from
+group_send() to each member's receive()), then back to back (throughput:
+deliveries per second until every member has every event). Layers:
+
+* inmemory: channels' InMemoryChannelLayer (the test configuration);
+* local: LocalFanoutChannelLayer on one node;
+* local_2_nodes: two LocalFanoutChannelLayer nodes over the in-memory
+  transport, members split evenly, sending from the first;
+* redis / local_redis: RedisChannelLayer (the current production
+  configuration) and LocalFanoutChannelLayer with a Redis shard, when
+  ``--redis`` is reachable.
+
+Usage: python -m benchmarks.channel_layer [--members 1000] [--events 50] [--redis redis://127.0.0.1:6379/0]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'comment_system.settings')
+django.setup()
+
+from channels.layers import InMemoryChannelLayer  # noqa: E402
+
+from comments.broadcasts import encode  # noqa: E402
+from comments.channel_layers import LocalFanoutChannelLayer  # noqa: E402
+
+from .fanout_cpu import comment_event  # noqa: E402
+from .report import latency  # noqa: E402
+
+GROUP = 'comments_page_1'
+
+
+def layers(name, capacity, redis_url):
+    """The node layers for ``name``; members are spread over them, and the first one sends."""
+    shard = f'memory://{uuid.uuid4().hex}'
+    if name == 'inmemory':
+        return [InMemoryChannelLayer(capacity=capacity)]
+    if name == 'local':
+        return [LocalFanoutChannelLayer(shards=[shard], capacity=capacity)]
+    if name == 'local_2_nodes':
+        return [LocalFanoutChannelLayer(shards=[shard], capacity=capacity) for _ in range(2)]
+    if name == 'redis':
+        from channels_redis.core import RedisChannelLayer
+        return [RedisChannelLayer(hosts=[redis_url], capacity=capacity)]
+    if name == 'local_redis':
+        return [LocalFanoutChannelLayer(shards=[redis_url], capacity=capacity)]
+    raise ValueError(name)
+
+
+async def redis_reachable(url):
+    import redis.asyncio
+
+    client = redis.asyncio.Redis.from_url(url, socket_connect_timeout=1)
+    try:
+        await client.ping()
+        return True
+    except Exception:
+        return False
+    finally:
+        await client.aclose()
+
+
+async def run(name, members, events, redis_url):
+    nodes = layers(name, capacity=events + 10, redis_url=redis_url)
+    sender = nodes[0]
+    channels = []
+    for i in range(members):
+        layer = nodes[i % len(nodes)]
+        channel = await layer.new_channel()
+        await layer.group_add(GROUP, channel)
+        channels.append((layer, channel))
+
+    async def receive_all(count):
+        async def receive(layer, channel):
+            return [(await layer.receive(channel), time.perf_counter()) for _ in range(count)]
+        return await asyncio.gather(*(receive(layer, channel) for layer, channel in channels))
+
+    event = encode(comment_event(1))
+    samples = []
+    send_ms = []
+    try:
+        for _ in range(events):
+            receiving = asyncio.ensure_future(receive_all(1))
+            await asyncio.sleep(0)  # receivers waiting, as consumers would be
+            started = time.perf_counter()
+            await sender.group_send(GROUP, event)
+            send_ms.append((time.perf_counter() - started) * 1000)
+            for received in await receiving:
+                samples.extend((at - started) * 1000 for _, at in received)
+
+        started = time.perf_counter()
+        for _ in range(events):
+            await sender.group_send(GROUP, event)
+        deliveries = sum(len(received) for received in await receive_all(events))
+        elapsed = time.perf_counter() - started
+    finally:
+        for layer, channel in channels:
+            await layer.group_discard(GROUP, channel)
+        for layer in nodes:
+            if hasattr(layer, 'close'):
+                await layer.close()
+    return {
+        'delivery': latency(samples),
+        'group_send': latency(send_ms),
+        'deliveries_per_s': round(deliveries / elapsed),
+    }
+
+
+async def main_async(args):
+    names = ['inmemory', 'local', 'local_2_nodes']
+    if await redis_reachable(args.redis):
+        names += ['redis', 'local_redis']
+    results = {}
+    for name in names:
+        results[name] = await run(name, args.members, args.events, args.redis)
+    if 'redis' not in results:
+        results['redis'] = {'skipped': f'no Redis at {args.redis}'}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--members', type=int, default=1000, help='Channels in the group')
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--redis', default='redis://127.0.0.1:6379/0')
+    args = parser.parse_args(argv)
+    report = {'members': args.members, 'events': args.events, 'layers': asyncio.run(main_async(args))}
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+    main()
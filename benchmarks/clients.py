@@ -0,0 +1,151 @@
+"""
+In-process clients for the project's ASGI application.
+
+Requests go through the same ProtocolTypeRouter, middleware, auth and
+consumers as under daphne, minus the sockets, so timings measure the
+application itself. A QueryCounter counts SQL statements on every database
+connection, including the ones Django opens in its sync worker thread.
+"""
+import json
+import threading
+import time
+from importlib import import_module
+from urllib.parse import urlencode
+
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.middleware.csrf import _get_new_csrf_string
+
+from .env import HOST
+
+TIMEOUT = 30
+
+
+def application():
+    from comment_system.asgi import application
+    return application
+
+
+class QueryCounter:
+    """Counts SQL statements executed on any connection while installed."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _attach(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def install(self):
+        # New connections (one per request with CONN_MAX_AGE=0) get the wrapper as they open
+        connection_created.connect(self._attach, weak=False)
+        for connection in connections.all(initialized_only=True):
+            self._attach(connection)
+
+    def uninstall(self):
+        connection_created.disconnect(self._attach)
+        for connection in connections.all(initialized_only=True):
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+class Response:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class Session:
+    """Cookies for one (optionally logged-in) visitor, with a CSRF token ready for unsafe requests."""
+
+    def __init__(self, user=None):
+        self.csrf_token = _get_new_csrf_string()
+        self.cookies = {settings.CSRF_COOKIE_NAME: self.csrf_token}
+        if user is not None:
+            store = import_module(settings.SESSION_ENGINE).SessionStore()
+            store[SESSION_KEY] = str(user.pk)
+            store[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+            store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            store.save()
+            self.cookies[settings.SESSION_COOKIE_NAME] = store.session_key
+
+    def headers(self):
+        cookie = '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+        return [
+            (b'host', HOST.encode()),
+            (b'origin', f'http://{HOST}'.encode()),
+            (b'cookie', cookie.encode()),
+        ]
+
+
+class HttpClient:
+    def __init__(self, app, session=None):
+        self.app = app
+        self.session = session or Session()
+
+    async def request(self, method, path, data=None, json_body=None, headers=()):
+        extra = list(headers)
+        body = b''
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            extra.append((b'content-type', b'application/json'))
+        elif data is not None:
+            body = urlencode(data).encode()
+            extra.append((b'content-type', b'application/x-www-form-urlencoded'))
+        if body:
+            extra.append((b'content-length', str(len(body)).encode()))
+        if method.upper() not in ('GET', 'HEAD', 'OPTIONS'):
+            extra.append((b'x-csrftoken', self.session.csrf_token.encode()))
+        communicator = HttpCommunicator(self.app, method, path, body, self.session.headers() + extra)
+        try:
+            response = await communicator.get_response(timeout=TIMEOUT)
+        finally:
+            await communicator.wait()
+        return Response(response['status'], response['headers'], response['body'])
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+
+class WebSocketClient:
+    """A connected socket that timestamps every message it receives."""
+
+    def __init__(self, app, path, session=None):
+        self.session = session or Session()
+        self.communicator = WebsocketCommunicator(app, path, headers=self.session.headers())
+
+    async def connect(self, greeting=True):
+        connected, _ = await self.communicator.connect(timeout=TIMEOUT)
+        if not connected:
+            raise RuntimeError('WebSocket connection refused')
+        if greeting:
+            await self.communicator.receive_json_from(timeout=TIMEOUT)  # connection_established
+
+    async def send(self, frame):
+        await self.communicator.send_json_to(frame)
+
+    async def receive(self, type_, timeout=TIMEOUT):
+        """Wait for the next message of ``type_``; return (message, perf_counter at receipt)."""
+        while True:
+            message = await self.communicator.receive_json_from(timeout=timeout)
+            if message.get('type') == type_:
+                return message, time.perf_counter()
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
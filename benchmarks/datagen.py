@@ -0,0 +1,114 @@
+"""
+Bulk data for benchmarks: users, discussions, deep comment trees and votes.
+
+Rows are built in memory with every derived column already filled in (paths,
+depths, reply counts, vote counters, hot scores, page stats) and written with
+bulk_create, so a dataset of hundreds of thousands of comments takes seconds
+rather than the hours one save() per row would. Generation is deterministic
+for a given seed.
+"""
+import random
+from collections import Counter, defaultdict, namedtuple
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from comments import ranking
+from comments.models import Comment, Page, Vote
+
+BATCH_SIZE = 2000
+WORDS = (
+    'django channels websocket thread reply vote cache query index latency '
+    'render template comment discussion page user server client database '
+    'transaction redis async sync worker queue event update fragment tree'
+).split()
+
+Dataset = namedtuple('Dataset', ['user_ids', 'page_ids', 'comments_by_page', 'votes'])
+
+
+def _text(rng, low, high):
+    return ' '.join(rng.choices(WORDS, k=rng.randint(low, high))).capitalize() + '.'
+
+
+def _next_id(model):
+    return (model.objects.aggregate(top=Max('pk'))['top'] or 0) + 1
+
+
+def generate(users=50, pages=20, comments_per_page=200, max_depth=8, reply_ratio=0.7,
+             votes_per_comment=2.0, seed=0):
+    """Create the rows and return a Dataset of their ids.
+
+    Each comment replies, with probability ``reply_ratio``, to one of the
+    page's recent comments shallower than ``max_depth``, which grows long
+    reply chains; otherwise it starts a new top-level thread.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    password = make_password('bench')
+
+    with transaction.atomic():
+        first_user = _next_id(User)
+        User.objects.bulk_create([
+            User(pk=first_user + i, username=f'bench{first_user + i}', password=password)
+            for i in range(users)
+        ], batch_size=BATCH_SIZE)
+        user_ids = list(range(first_user, first_user + users))
+
+        first_page = _next_id(Page)
+        page_ids = list(range(first_page, first_page + pages))
+
+        comments = []
+        comments_by_page = defaultdict(list)
+        next_comment = _next_id(Comment)
+        for page_id in page_ids:
+            recent = []
+            for _ in range(comments_per_page):
+                candidates = [c for c in recent[-20:] if c.depth + 1 < max_depth]
+                parent = rng.choice(candidates) if candidates and rng.random() < reply_ratio else None
+                comment = Comment(
+                    pk=next_comment, page_id=page_id, author_id=rng.choice(user_ids),
+                    content=_text(rng, 5, 40), parent_id=parent.pk if parent else None,
+                )
+                comment.path = (parent.path if parent else '') + Comment.path_segment(comment.pk)
+                comment.depth = parent.depth + 1 if parent else 0
+                if parent:
+                    parent.reply_count += 1
+                comments.append(comment)
+                comments_by_page[page_id].append(comment.pk)
+                recent.append(comment)
+                next_comment += 1
+
+        votes = []
+        for comment in comments:
+            voters = rng.sample(user_ids, min(len(user_ids), int(rng.expovariate(1 / votes_per_comment))))
+            for user_id in voters:
+                vote_type = 'up' if rng.random() < 0.75 else 'down'
+                votes.append(Vote(user_id=user_id, comment_id=comment.pk, vote_type=vote_type))
+                if vote_type == 'up':
+                    comment.upvotes += 1
+                else:
+                    comment.downvotes += 1
+            comment.score = comment.upvotes - comment.downvotes
+            comment.hot_score = ranking.hot_score(ranking.comment_points(comment.score, comment.reply_count), now, now)
+
+        page_scores = Counter()
+        for comment in comments:
+            page_scores[comment.page_id] += comment.score
+        Page.objects.bulk_create([
+            Page(
+                pk=page_id, title=_text(rng, 3, 8).rstrip('.'), content=_text(rng, 30, 120),
+                comment_count=comments_per_page, last_activity_at=now,
+                hot_points=page_scores[page_id] + ranking.REPLY_WEIGHT * comments_per_page + 1,
+                hot_score=ranking.hot_score(
+                    page_scores[page_id] + ranking.REPLY_WEIGHT * comments_per_page + 1, now, now,
+                ),
+            )
+            for page_id in page_ids
+        ], batch_size=BATCH_SIZE)
+        Comment.objects.bulk_create(comments, batch_size=BATCH_SIZE)
+        Vote.objects.bulk_create(votes, batch_size=BATCH_SIZE)
+
+    return Dataset(user_ids, page_ids, dict(comments_by_page), len(votes))
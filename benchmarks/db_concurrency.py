@@ -0,0 +1,178 @@
+"""
+Mixed concurrent readers and writers against SQLite, by database profile.
+
+Each profile gets its own copy of one generated dataset (benchmarks.datagen).
+``--readers`` threads then load discussion pages, as page_detail does on a
+cache miss, and ``--writers`` threads post comments and cast votes, as the
+views do, all for ``--seconds``. Every operation ends the way a request
+does, with close_old_connections(). Profiles:
+
+* baseline: Django's SQLite defaults, with a rollback journal, deferred
+  transactions, a 5 second busy timeout and a new connection per request;
+* tuned: the project's settings (WAL, pragmas, immediate transactions,
+  persistent connections).
+
+The JSON report has throughput, latency and failures ("database is locked"
+and other errors) for reads and writes under each profile.
+
+Usage: python -m benchmarks.db_concurrency [--readers 8] [--writers 4] [--seconds 5]
+"""
+import argparse
+import json
+import random
+import shutil
+import threading
+import time
+
+from . import env
+
+BASELINE = {'OPTIONS': {}, 'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False}
+
+
+def tuned_profile():
+    from django.conf import settings
+
+    default = settings.DATABASES['default']
+    return {key: default.get(key) for key in BASELINE}
+
+
+def use_database(path, profile):
+    """Point the default alias at ``path`` with ``profile``'s settings; threads connect anew."""
+    from django.db import connections
+
+    connections.close_all()
+    connections.settings['default'].update(NAME=path, **profile)
+
+
+def read_page(page_id):
+    from comments.models import Comment, Page
+
+    Page.objects.filter(pk=page_id).values_list('thread_version', 'updated_at').first()
+    roots = list(
+        Comment.objects.filter(page_id=page_id, parent__isnull=True, is_deleted=False)
+        .select_related('author').order_by('-created_at')[:20]
+    )
+    list(Comment.objects.filter(parent__in=roots, is_deleted=False).select_related('author'))
+
+
+def write(rng, dataset, users):
+    from django.db import transaction
+
+    from comments.broadcasts import publish_new_comment
+    from comments.models import Comment
+    from comments.votes import cast_vote
+
+    page_id = rng.choice(dataset.page_ids)
+    if rng.random() < 0.5:
+        with transaction.atomic():
+            comment = Comment.objects.create(page_id=page_id, author=rng.choice(users), content='Benchmark comment.')
+            publish_new_comment(comment)
+    else:
+        comment = Comment.objects.get(pk=rng.choice(dataset.comments_by_page[page_id]))
+        cast_vote(rng.choice(users), comment, rng.choice(['up', 'down']))
+
+
+def run(dataset, readers, writers, seconds, seed):
+    from django.contrib.auth.models import User
+    from django.db import OperationalError, close_old_connections, connection
+
+    from . import report
+
+    users = list(User.objects.filter(pk__in=dataset.user_ids))
+    close_old_connections()
+    samples = {'read': [], 'write': []}
+    failures = {'read': {}, 'write': {}}
+    lock = threading.Lock()
+    start = threading.Barrier(readers + writers)
+
+    def worker(kind, index):
+        rng = random.Random(seed * 1000 + index)
+        timings, errors = [], {}
+        try:
+            start.wait()
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    if kind == 'read':
+                        read_page(rng.choice(dataset.page_ids))
+                    else:
+                        write(rng, dataset, users)
+                    timings.append((time.perf_counter() - started) * 1000)
+                except OperationalError as e:
+                    reason = 'database is locked' if 'locked' in str(e) else type(e).__name__
+                    errors[reason] = errors.get(reason, 0) + 1
+                finally:
+                    close_old_connections()
+        finally:
+            connection.close()
+            with lock:
+                samples[kind].extend(timings)
+                for reason, count in errors.items():
+                    failures[kind][reason] = failures[kind].get(reason, 0) + count
+
+    threads = [threading.Thread(target=worker, args=('read', i)) for i in range(readers)]
+    threads += [threading.Thread(target=worker, args=('write', readers + i)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        kind: {
+            'ops_per_s': round(len(samples[kind]) / seconds, 1),
+            'latency': report.latency(samples[kind]),
+            'failures': failures[kind],
+        }
+        for kind in ('read', 'write')
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5.0, help='Per profile')
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--comments-per-page', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    from django.conf import settings
+
+    profiles = {'baseline': BASELINE, 'tuned': tuned_profile()}
+    # The dataset is generated without the tuned settings, so its file isn't left in WAL mode
+    settings.DATABASES['default'].update(BASELINE)
+    template = env.configure()
+    from django.db import connections
+
+    from . import datagen, report
+
+    paths = []
+    try:
+        dataset = datagen.generate(pages=args.pages, comments_per_page=args.comments_per_page, seed=args.seed)
+        results = {}
+        for name, profile in profiles.items():
+            path = template.replace('db.sqlite3', f'{name}.sqlite3')
+            connections.close_all()
+            shutil.copyfile(template, path)
+            paths.append(path)
+            use_database(path, profile)
+            results[name] = run(dataset, args.readers, args.writers, args.seconds, args.seed)
+    finally:
+        for path in paths:
+            env.remove(path)
+        env.remove(template)
+
+    result = {
+        'environment': report.environment(),
+        'readers': args.readers,
+        'writers': args.writers,
+        'seconds': args.seconds,
+        'profiles': results,
+    }
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == '__main__':
+    main()
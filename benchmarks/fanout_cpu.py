@@ -0,0 +1,103 @@
+"""
+CPU spent delivering one live event to a page group, by group size.
+
+Each of ``--sizes`` viewers is a CommentConsumer whose socket writes are
+discarded, so only the application's own work is timed: the publisher's
+encode() plus every recipient's handler. Two ways of delivering are compared:
+
+* per recipient: the event carries its fields and each consumer serializes
+  them for its own socket (how every event was sent before encode());
+* pre-encoded: the publisher serializes once and consumers forward the text.
+
+Usage: python -m benchmarks.fanout_cpu [--sizes 10,100,1000,5000] [--events 20]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'comment_system.settings')
+django.setup()
+
+from comments.broadcasts import encode  # noqa: E402
+from comments.consumers import CommentConsumer  # noqa: E402
+
+# About the size of a rendered comment fragment
+FRAGMENT = '<div class="comment" data-comment-id="1">' + 'Lorem ipsum dolor sit amet. ' * 50 + '</div>'
+
+
+def comment_event(i):
+    return {
+        'type': 'comment_message',
+        'comment': {
+            'id': i,
+            'author': 'alice',
+            'content': 'Lorem ipsum dolor sit amet. ' * 10,
+            'created_at': '2025-01-01T00:00:00+00:00',
+            'parent_id': None,
+            'depth': 0,
+            'html': FRAGMENT,
+        },
+    }
+
+
+def viewers(count):
+    """Consumers ready to receive group events, writing into the void."""
+    async def discard(message):
+        pass
+
+    consumers = []
+    for _ in range(count):
+        consumer = CommentConsumer()
+        consumer.base_send = discard
+        consumers.append(consumer)
+    return consumers
+
+
+async def deliver(consumers, events, pre_encoded):
+    """Seconds of CPU per event to hand each of ``events`` to every consumer."""
+    started = time.process_time()
+    for event in events:
+        if pre_encoded:
+            event = encode(event)
+        for consumer in consumers:
+            await consumer.comment_message(event)
+    return (time.process_time() - started) / len(events)
+
+
+def measure(sizes, events=20, repeat=3):
+    """[{recipients, per_recipient_us, pre_encoded_us, speedup}] per group size, best of ``repeat``."""
+    async def run():
+        rows = []
+        batch = [comment_event(i) for i in range(events)]
+        for size in sizes:
+            consumers = viewers(size)
+            old = min([await deliver(consumers, batch, pre_encoded=False) for _ in range(repeat)])
+            new = min([await deliver(consumers, batch, pre_encoded=True) for _ in range(repeat)])
+            rows.append({
+                'recipients': size,
+                'per_recipient_us': round(old * 1e6, 1),
+                'pre_encoded_us': round(new * 1e6, 1),
+                'speedup': round(old / new, 1) if new else None,
+            })
+        return rows
+    return asyncio.run(run())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='10,100,1000,5000', help='Comma-separated group sizes')
+    parser.add_argument('--events', type=int, default=20, help='Events delivered per measurement')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    report = {'event_bytes': len(json.dumps(comment_event(0))), 'groups': measure(sizes, args.events, args.repeat)}
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+    main()
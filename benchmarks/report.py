@@ -0,0 +1,51 @@
+"""
+Latency summaries and run metadata shared by the benchmarks' JSON reports.
+
+Reports carry the commit and library versions they were produced with, so
+two runs can be diffed with ``python -m benchmarks.stack --compare``.
+"""
+import platform
+import sqlite3
+import statistics
+import subprocess
+
+import django
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def latency(samples_ms):
+    """p50/p95/p99/max/mean of a list of millisecond timings."""
+    if not samples_ms:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None, 'mean_ms': None}
+    return {
+        'p50_ms': round(percentile(samples_ms, 50), 2),
+        'p95_ms': round(percentile(samples_ms, 95), 2),
+        'p99_ms': round(percentile(samples_ms, 99), 2),
+        'max_ms': round(max(samples_ms), 2),
+        'mean_ms': round(statistics.fmean(samples_ms), 2),
+    }
+
+
+def _git(*args):
+    try:
+        return subprocess.run(
+            ['git', *args], capture_output=True, text=True, check=True, timeout=10,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment():
+    status = _git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'commit': _git('rev-parse', '--short', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+    }
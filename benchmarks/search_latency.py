@@ -0,0 +1,137 @@
+"""
+Full-text search latency over a large generated corpus.
+
+Builds a scratch SQLite database (never the project's), migrates it, fills it
+with ``--pages`` discussions and ``--comments`` comments whose words follow a
+Zipf distribution, then times comments.search.search() end to end (ranking,
+highlighting and loading the matched rows) for common, mid-frequency, rare,
+two-word and prefix queries.
+
+For comparison it also times a few queries with every match ranked
+(no candidate cap) and through the LIKE fallback other databases use.
+
+With --db the database is kept, and a later run with the same --db skips
+generation.
+
+Usage: python -m benchmarks.search_latency [--comments 1000000] [--queries 200] [--db PATH]
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+from . import env
+from .report import environment, latency
+
+VOCABULARY = 20000
+BATCH_SIZE = 5000
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'pa', 'do', 'gu', 'be', 'fi', 'ho', 'ja']
+
+
+def make_words(rng):
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    # Ranked by frequency: words[0] is the most common
+    return sorted(words, key=lambda w: rng.random())
+
+
+def generate(pages, comments, words, rng):
+    from django.contrib.auth.models import User
+    from django.db import transaction
+    from comments.models import Comment, Page
+
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    cum_weights = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cum_weights.append(total)
+
+    def text(low, high):
+        return ' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(low, high)))
+
+    users = [User.objects.create_user(f'bench{i}') for i in range(20)]
+    Page.objects.bulk_create([Page(title=text(3, 8), content=text(30, 80)) for _ in range(pages)])
+    page_ids = list(Page.objects.values_list('pk', flat=True))
+    for start in range(0, comments, BATCH_SIZE):
+        with transaction.atomic():
+            Comment.objects.bulk_create([
+                Comment(page_id=rng.choice(page_ids), author=rng.choice(users), content=text(8, 40))
+                for _ in range(min(BATCH_SIZE, comments - start))
+            ])
+
+
+def queries(words, count, rng):
+    common, mid, rare = words[:10], words[100:1000], words[5000:]
+    return {
+        'common': [rng.choice(common) for _ in range(count)],
+        'mid': [rng.choice(mid) for _ in range(count)],
+        'rare': [rng.choice(rare) for _ in range(count)],
+        'two_words': [f'{rng.choice(common)} {rng.choice(mid)}' for _ in range(count)],
+        'prefix': [rng.choice(mid)[:3] + '*' for _ in range(count)],
+    }
+
+
+def timed(run, terms):
+    samples = []
+    for term in terms:
+        start = time.perf_counter()
+        run(term)
+        samples.append((time.perf_counter() - start) * 1000)
+    return {'queries': len(samples), **latency(samples)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=200, help='Queries per class')
+    parser.add_argument('--baseline-queries', type=int, default=5, help='Queries for the uncapped and LIKE baselines')
+    parser.add_argument('--db', help='SQLite file to use (default: a temporary file, removed afterwards)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    reuse = bool(args.db) and os.path.exists(args.db)
+    db_path = env.configure(args.db)
+    from comments import search
+    from comments.models import Comment
+
+    rng = random.Random(args.seed)
+    words = make_words(rng)
+    started = time.perf_counter()
+    if not reuse:
+        generate(args.pages, args.comments, words, rng)
+    build_seconds = time.perf_counter() - started
+
+    classes = queries(words, args.queries, rng)
+    # Warm the page cache so the first class isn't charged for it
+    for term in classes['common'][:10]:
+        search.search(term)
+    report = {
+        'environment': environment(),
+        'comments': Comment.objects.count(),
+        'build_seconds': None if reuse else round(build_seconds, 1),
+        'candidates': search.CANDIDATES,
+        'after': {name: timed(search.search, terms) for name, terms in classes.items()},
+    }
+    report['after']['all'] = timed(search.search, [t for terms in classes.values() for t in terms])
+
+    baseline = classes['common'][:args.baseline_queries]
+    capped = search.CANDIDATES
+    search.CANDIDATES = 1 << 62
+    try:
+        report['before_uncapped_common'] = timed(search.search, baseline)
+    finally:
+        search.CANDIDATES = capped
+    report['before_like_common'] = timed(lambda term: search._search_like(term, 0, 20), baseline)
+
+    print(json.dumps(report, indent=2))
+    if not args.db:
+        env.remove(db_path)
+    return report
+
+
+if __name__ == '__main__':
+    main()
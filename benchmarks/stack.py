@@ -0,0 +1,330 @@
+"""
+Load test for the whole stack: HTML views, the REST API, votes and WebSocket fan-out.
+
+Generates a dataset (benchmarks.datagen) in a scratch database, then drives
+the ASGI application in-process (benchmarks.clients) scenario by scenario and
+prints a JSON report: per scenario throughput, p50/p95/p99 latency and SQL
+queries per request (per event for fan-out, with delivery latency measured
+from the triggering request to each viewer's receipt; per user for the
+connect scenarios, which open a logged-in user's live updates for
+``--pages-per-user`` pages and notifications). Cache and channel
+layer are in-memory, so no Redis is needed.
+
+Reports include the commit they ran on; compare two with --compare:
+
+    python -m benchmarks.stack --output before.json
+    ... change something ...
+    python -m benchmarks.stack --compare before.json
+
+Usage: python -m benchmarks.stack [--requests 200] [--concurrency 1] [--viewers 100]
+                                  [--scenarios homepage,vote_api,...] [--output FILE] [--compare FILE]
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+from . import env
+
+READ_SCENARIOS = ['homepage', 'page_detail', 'page_detail_logged_in', 'api_pages', 'api_page_comments', 'api_comments']
+WRITE_SCENARIOS = ['vote_html', 'vote_api', 'api_create_comment']
+FANOUT_SCENARIOS = ['ws_new_comment', 'ws_vote']
+CONNECT_SCENARIOS = ['ws_connect_per_page', 'ws_connect_live']
+SCENARIOS = READ_SCENARIOS + WRITE_SCENARIOS + FANOUT_SCENARIOS + CONNECT_SCENARIOS
+
+
+class Stack:
+    """The application, a dataset and logged-in sessions for its users."""
+
+    def __init__(self, app, dataset, seed):
+        from django.contrib.auth.models import User
+        from .clients import HttpClient, Session
+
+        self.app = app
+        self.dataset = dataset
+        self.rng = random.Random(seed)
+        users = User.objects.in_bulk(dataset.user_ids)
+        self.sessions = [Session(users[pk]) for pk in dataset.user_ids]
+        self.anonymous = HttpClient(app)
+        self.clients = [HttpClient(app, session) for session in self.sessions]
+
+    def page(self, i):
+        return self.dataset.page_ids[i % len(self.dataset.page_ids)]
+
+    def comment(self, page_id=None):
+        page_id = page_id or self.rng.choice(self.dataset.page_ids)
+        return self.rng.choice(self.dataset.comments_by_page[page_id])
+
+    def client(self, i):
+        return self.clients[i % len(self.clients)]
+
+    def call(self, scenario, i):
+        """The request scenario ``scenario`` sends on its ``i``-th iteration."""
+        xhr = [(b'x-requested-with', b'XMLHttpRequest')]
+        return {
+            'homepage': lambda: self.anonymous.get('/'),
+            'page_detail': lambda: self.anonymous.get(f'/page/{self.page(i)}/'),
+            'page_detail_logged_in': lambda: self.client(i).get(f'/page/{self.page(i)}/'),
+            'api_pages': lambda: self.anonymous.get('/api/pages/'),
+            'api_page_comments': lambda: self.anonymous.get(f'/api/pages/{self.page(i)}/comments/?depth=3'),
+            'api_comments': lambda: self.anonymous.get(f'/api/comments/?page={self.page(i)}'),
+            'vote_html': lambda: self.client(i).post(
+                f'/comment/{self.comment()}/vote/', data={'vote_type': 'up'}, headers=xhr,
+            ),
+            'vote_api': lambda: self.client(i).post(
+                f'/api/comments/{self.comment()}/vote/', json_body={'vote_type': 'down'},
+            ),
+            'api_create_comment': lambda: self.client(i).post('/api/comments/', json_body={
+                'page': self.page(i), 'parent': self.comment(self.page(i)), 'content': f'Benchmark reply {i}',
+            }),
+        }[scenario]()
+
+
+async def run_requests(stack, scenario, requests, concurrency, warmup, counter):
+    from .report import latency
+
+    for i in range(warmup):
+        await stack.call(scenario, i)
+    samples = []
+    errors = []
+    indexes = iter(range(warmup, warmup + requests))
+    queries_before = counter.count
+
+    async def worker():
+        for i in indexes:
+            started = time.perf_counter()
+            response = await stack.call(scenario, i)
+            samples.append((time.perf_counter() - started) * 1000)
+            if response.status >= 400:
+                errors.append(response.status)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'throughput_rps': round(requests / elapsed, 1),
+        **latency(samples),
+        'queries_per_request': round((counter.count - queries_before) / requests, 2),
+    }
+
+
+async def run_fanout(stack, scenario, viewers, events, counter):
+    """Connect ``viewers`` sockets to one page, trigger ``events`` and time each delivery."""
+    from .clients import WebSocketClient
+    from .report import latency
+
+    page_id = stack.page(0)
+    message_type = {'ws_new_comment': 'new_comment', 'ws_vote': 'vote_update'}[scenario]
+    author = stack.client(0)
+
+    def trigger(i):
+        if scenario == 'ws_new_comment':
+            return author.post('/api/comments/', json_body={'page': page_id, 'content': f'Live comment {i}'})
+        return stack.client(i).post(
+            f'/api/comments/{stack.comment(page_id)}/vote/', json_body={'vote_type': 'up'},
+        )
+
+    sockets = [WebSocketClient(stack.app, f'/ws/comments/{page_id}/') for _ in range(viewers)]
+    connect_ms = []
+
+    async def connect(socket):
+        started = time.perf_counter()
+        await socket.connect()
+        connect_ms.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(connect(socket) for socket in sockets))
+    trigger_ms = []
+    delivery_ms = []
+    errors = 0
+    queries_before = counter.count
+    started_all = time.perf_counter()
+    try:
+        for i in range(events):
+            waiting = [asyncio.ensure_future(socket.receive(message_type)) for socket in sockets]
+            started = time.perf_counter()
+            response = await trigger(i)
+            trigger_ms.append((time.perf_counter() - started) * 1000)
+            if response.status >= 400:
+                # Nothing will be delivered; don't wait out the timeout
+                errors += 1
+                for future in waiting:
+                    future.cancel()
+                continue
+            for _, received_at in await asyncio.gather(*waiting):
+                delivery_ms.append((received_at - started) * 1000)
+        elapsed = time.perf_counter() - started_all
+    finally:
+        await asyncio.gather(*(socket.disconnect() for socket in sockets))
+    return {
+        'viewers': viewers,
+        'events': events,
+        'errors': errors,
+        'deliveries': len(delivery_ms),
+        'deliveries_per_s': round(len(delivery_ms) / elapsed, 1),
+        'connect': latency(connect_ms),
+        'trigger': latency(trigger_ms),
+        'delivery': latency(delivery_ms),
+        'queries_per_event': round((counter.count - queries_before) / events, 2),
+    }
+
+
+async def run_connect(stack, scenario, users, pages_per_user, counter):
+    """Open ``users`` logged-in users' live updates: a socket per page plus one for notifications, or one in all."""
+    from .clients import WebSocketClient
+    from .report import latency
+
+    async def connect(i):
+        session = stack.sessions[i % len(stack.sessions)]
+        pages = [stack.page(i + n) for n in range(pages_per_user)]
+        started = time.perf_counter()
+        if scenario == 'ws_connect_per_page':
+            sockets = [WebSocketClient(stack.app, f'/ws/comments/{page}/', session) for page in pages]
+            await asyncio.gather(*(socket.connect() for socket in sockets))
+            notifications = WebSocketClient(stack.app, '/ws/notifications/', session)
+            await notifications.connect(greeting=False)
+            sockets.append(notifications)
+        else:
+            sockets = [WebSocketClient(stack.app, '/ws/live/', session)]
+            await sockets[0].connect()
+            for page in pages:
+                await sockets[0].send({'type': 'subscribe', 'page': page})
+            await sockets[0].send({'type': 'subscribe', 'stream': 'notifications'})
+            for _ in range(pages_per_user + 1):
+                await sockets[0].receive('subscribed')
+        return (time.perf_counter() - started) * 1000, sockets
+
+    queries_before = counter.count
+    started = time.perf_counter()
+    results = await asyncio.gather(*(connect(i) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    queries = counter.count - queries_before
+    sockets = [socket for _, user_sockets in results for socket in user_sockets]
+    await asyncio.gather(*(socket.disconnect() for socket in sockets))
+    return {
+        'users': users,
+        'throughput_rps': round(users / elapsed, 1),
+        **latency([ms for ms, _ in results]),
+        'sockets_per_user': len(sockets) / users,
+        'queries_per_user': round(queries / users, 2),
+    }
+
+
+def compare(old, new):
+    """Lines describing how each scenario's p95 latency and throughput moved between two reports."""
+    lines = [f"{'scenario':24} {'p95 ms (old → new)':>26} {'throughput (old → new)':>30}"]
+    for name, result in new['scenarios'].items():
+        before = old.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        if 'delivery' in result:
+            p95 = (before['delivery']['p95_ms'], result['delivery']['p95_ms'])
+            rate = (before['deliveries_per_s'], result['deliveries_per_s'])
+        else:
+            p95 = (before['p95_ms'], result['p95_ms'])
+            rate = (before['throughput_rps'], result['throughput_rps'])
+        change = f'{(p95[1] - p95[0]) / p95[0]:+.0%}' if p95[0] else ''
+        lines.append(f'{name:24} {p95[0]:>9} → {p95[1]:<9} {change:>5} {rate[0]:>13} → {rate[1]:<13}')
+    return lines
+
+
+async def run(stack, args, counter):
+    results = {}
+    for scenario in args.scenarios:
+        if scenario in FANOUT_SCENARIOS:
+            results[scenario] = await run_fanout(stack, scenario, args.viewers, args.events, counter)
+        elif scenario in CONNECT_SCENARIOS:
+            results[scenario] = await run_connect(stack, scenario, args.viewers, args.pages_per_user, counter)
+        else:
+            results[scenario] = await run_requests(
+                stack, scenario, args.requests, args.concurrency, args.warmup, counter,
+            )
+        print(f'{scenario}: done', file=sys.stderr)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--comments-per-page', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=8, help='Deepest reply level generated')
+    parser.add_argument('--votes-per-comment', type=float, default=2.0)
+    parser.add_argument('--requests', type=int, default=200, help='Timed requests per HTTP scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight per HTTP scenario')
+    parser.add_argument('--warmup', type=int, default=5, help='Untimed requests before each HTTP scenario')
+    parser.add_argument('--viewers', type=int, default=100, help='WebSocket clients per fan-out or connect scenario')
+    parser.add_argument('--pages-per-user', type=int, default=3, help='Pages each user follows in connect scenarios')
+    parser.add_argument('--events', type=int, default=20, help='Events per fan-out scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma-separated; default all')
+    parser.add_argument('--db', help='SQLite file to use (default: a temporary file, removed afterwards)')
+    parser.add_argument('--output', help='Also write the report to this file')
+    parser.add_argument('--compare', help='A previous report to compare against (printed to stderr)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    args.scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}; choose from {', '.join(SCENARIOS)}")
+
+    db_path = env.configure(args.db)
+    from . import datagen, report
+    from .clients import QueryCounter, application
+
+    try:
+        started = time.perf_counter()
+        dataset = datagen.generate(
+            users=args.users, pages=args.pages, comments_per_page=args.comments_per_page,
+            max_depth=args.depth, votes_per_comment=args.votes_per_comment, seed=args.seed,
+        )
+        build_seconds = time.perf_counter() - started
+
+        # Sessions are created up front: the ORM can't be used from the event loop
+        stack = Stack(application(), dataset, args.seed)
+        counter = QueryCounter()
+        counter.install()
+        try:
+            scenarios = asyncio.run(run(stack, args, counter))
+        finally:
+            counter.uninstall()
+    finally:
+        if not args.db:
+            env.remove(db_path)
+
+    result = {
+        'environment': report.environment(),
+        'dataset': {
+            'users': args.users,
+            'pages': args.pages,
+            'comments': sum(len(ids) for ids in dataset.comments_by_page.values()),
+            'votes': dataset.votes,
+            'max_depth': args.depth,
+            'seed': args.seed,
+            'build_seconds': round(build_seconds, 2),
+        },
+        'settings': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'warmup': args.warmup,
+            'viewers': args.viewers,
+            'pages_per_user': args.pages_per_user,
+            'events': args.events,
+        },
+        'scenarios': scenarios,
+    }
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(json.load(f), result)), file=sys.stderr)
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Typing-indicator message volume, before and after server-side aggregation.
+
+Simulates ``--clients`` viewers on one page, ``--typists`` of whom type in
+bursts, on a virtual clock so the run is deterministic and instant:
+
+* before: every keystroke frame was re-broadcast to the page group, so each
+  frame reached every viewer;
+* after: clients send at most one frame per second, comments.typing records
+  them and one snapshot is broadcast per interval, only when the set changes.
+
+Usage: python -m benchmarks.typing_fanout [--clients 500] [--typists 20] [--seconds 60]
+"""
+import argparse
+import json
+import os
+import random
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'comment_system.settings')
+django.setup()
+
+from comments.typing import TypingTracker  # noqa: E402
+
+TICK = 0.05
+KEYSTROKE_INTERVAL = 0.15   # one input event per 150 ms while typing
+CLIENT_STOP_DELAY = 1.0     # both clients send "stopped" after 1 s without input
+CLIENT_RESEND_INTERVAL = 1.0
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def keystrokes(typists, seconds, seed):
+    """(time, typist) input events: bursts of 2-8 s of typing separated by 1-10 s pauses."""
+    rng = random.Random(seed)
+    events = []
+    for typist in range(typists):
+        t = rng.uniform(0, 5)
+        while t < seconds:
+            end = min(seconds, t + rng.uniform(2, 8))
+            while t < end:
+                events.append((round(t, 3), typist))
+                t += KEYSTROKE_INTERVAL
+            t = end + rng.uniform(1, 10)
+    events.sort()
+    return events
+
+
+def client_frames(events, throttled):
+    """(time, typist, is_typing) frames produced by the old or the new client script."""
+    frames = []
+    last_input = {}
+    last_sent = {}
+    for t, typist in events:
+        previous = last_input.get(typist)
+        if previous is not None and t - previous >= CLIENT_STOP_DELAY:
+            frames.append((previous + CLIENT_STOP_DELAY, typist, False))
+            last_sent.pop(typist, None)
+        last_input[typist] = t
+        if not throttled or t - last_sent.get(typist, -CLIENT_RESEND_INTERVAL) >= CLIENT_RESEND_INTERVAL:
+            frames.append((t, typist, True))
+            last_sent[typist] = t
+    for typist, t in last_input.items():
+        frames.append((t + CLIENT_STOP_DELAY, typist, False))
+    frames.sort(key=lambda f: f[0])
+    return frames
+
+
+def before(events, clients):
+    frames = client_frames(events, throttled=False)
+    return {'frames_received': len(frames), 'group_sends': len(frames), 'deliveries': len(frames) * clients}
+
+
+def after(events, clients, seconds, interval, ttl, min_frame_interval):
+    frames = client_frames(events, throttled=True)
+    clock = Clock()
+    tracker = TypingTracker(interval=interval, ttl=ttl, min_frame_interval=min_frame_interval, clock=clock)
+    page_id = 1
+    group_sends = 0
+    next_snapshot = interval
+    i = 0
+    while clock.now <= seconds + ttl + interval:
+        while i < len(frames) and frames[i][0] <= clock.now:
+            _, typist, is_typing = frames[i]
+            tracker.update(page_id, f'user{typist}', is_typing)
+            i += 1
+        if clock.now >= next_snapshot:
+            if tracker.snapshot(page_id) is not None:
+                group_sends += 1
+            next_snapshot += interval
+        clock.now = round(clock.now + TICK, 6)
+    return {'frames_received': len(frames), 'group_sends': group_sends, 'deliveries': group_sends * clients}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--typists', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--interval', type=float, default=0.3)
+    parser.add_argument('--ttl', type=float, default=3.0)
+    parser.add_argument('--min-frame-interval', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    events = keystrokes(args.typists, args.seconds, args.seed)
+    old = before(events, args.clients)
+    new = after(events, args.clients, args.seconds, args.interval, args.ttl, args.min_frame_interval)
+    report = {
+        'clients': args.clients,
+        'typists': args.typists,
+        'seconds': args.seconds,
+        'before': old,
+        'after': new,
+        'reduction': round(old['deliveries'] / new['deliveries'], 1) if new['deliveries'] else None,
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -44,6 +44,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so latency and queries include every other middleware
+    'comments.metrics.MetricsMiddleware',
+    'comments.query_stats.QueryStatsMiddleware',
+    # Above SessionMiddleware, so session saves count as writes (comments.db_router)
+    'comments.db_router.PrimaryPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,13 +82,50 @@ WSGI_APPLICATION = 'comment_system.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLite tuned for concurrent readers and writers (run `python -m benchmarks.db_concurrency`):
+# WAL lets reads proceed during a write; synchronous=NORMAL is durable across crashes in WAL
+# mode and syncs only at checkpoints; cache_size is per connection (negative: KiB);
+# mmap_size lets reads be served from the page cache without copying.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 128 * 1024 * 1024,
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'init_command': ';'.join(f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items()),
+            # Write transactions take the write lock at BEGIN, so a writer waits its turn for up
+            # to `timeout` seconds (SQLite's busy_timeout) instead of failing when it upgrades
+            # from reading to writing
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        # Keep each thread's connection (and its pragmas and page cache) between requests
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        # File-backed test database: SQLite's shared-cache in-memory mode fails
+        # concurrent writers immediately instead of waiting on the lock
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
+# Reads go to the aliases listed in DATABASE_REPLICAS (each also defined in DATABASES) and
+# writes to 'default'; a client that wrote reads from 'default' for READ_YOUR_WRITES_WINDOW
+# seconds after (comments.db_router). E.g. with a replicated copy of the database file:
+#     DATABASES['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'replica.sqlite3',
+#                             'TEST': {'MIRROR': 'default'}}
+#     DATABASE_REPLICAS = ['replica']
+DATABASE_ROUTERS = ['comments.db_router.ReplicaRouter']
+DATABASE_REPLICAS = []
+READ_YOUR_WRITES_WINDOW = 5
+
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -155,6 +197,7 @@ LOGOUT_REDIRECT_URL = 'comments:homepage'
 LOGIN_URL = 'login'
 
 COMMENT_EDIT_TIMEOUT_MINUTES = 5
+COMMENT_THREAD_MAX_DEPTH = None  # replies nested deeper than this are collapsed; None = unlimited
 
 
 ASGI_APPLICATION = 'comment_system.asgi.application'
@@ -167,6 +210,53 @@ CHANNEL_LAYERS = {
         },
     },
 }
+# Or deliver in process and cross the network only for viewers on other workers,
+# with group membership sharded over the listed servers by page id
+# (comments.channel_layers; 'memory://local' for a single process):
+# CHANNEL_LAYERS = {
+#     'default': {
+#         'BACKEND': 'comments.channel_layers.LocalFanoutChannelLayer',
+#         'CONFIG': {'shards': ['redis://127.0.0.1:6379/0']},
+#     },
+# }
+
+# Live vote_update events are coalesced per comment over this many seconds (0 = send every vote)
+VOTE_BROADCAST_WINDOW = 0.25
+
+# Hot ranking (comments.ranking): points / (age_hours + 2) ** HOT_GRAVITY, where points are
+# votes plus HOT_REPLY_WEIGHT per reply; re-decayed by `manage.py decay_hot_scores`
+HOT_GRAVITY = 1.8
+HOT_REPLY_WEIGHT = 2
+HOT_HORIZON_DAYS = 7  # older comments and discussions drop to a hot score of 0
+
+# Send each request's SQL count, time and slowest statements as X-Query-* and Server-Timing
+# response headers (comments.query_stats); they are always logged at DEBUG
+QUERY_STATS_HEADERS = DEBUG
+
+# Full-text search (comments.search) ranks only this many of the newest matches per query;
+# older ones are left out, and the results are marked as capped
+SEARCH_CANDIDATES = 1000
+
+# Live events go through a transactional outbox (comments.outbox), sent after commit by
+# 'thread' (a background thread per process), 'inline' (the committing thread) or
+# 'worker' (only by a separate `manage.py dispatch_outbox` process)
+OUTBOX_DISPATCH = 'thread'
+OUTBOX_POLL_INTERVAL = 1.0  # seconds between checks for retries
+OUTBOX_MAX_ATTEMPTS = 10
+
+# Typing indicators: one aggregated snapshot per page every TYPING_BROADCAST_INTERVAL seconds,
+# typists expire after TYPING_TTL seconds of silence, and each user's frames are rate-limited
+TYPING_BROADCAST_INTERVAL = 0.3
+TYPING_TTL = 3.0
+TYPING_MIN_FRAME_INTERVAL = 0.5
+
+# Pages one multiplexed socket (ws/live/) may follow at once
+LIVE_MAX_PAGE_SUBSCRIPTIONS = 20
+
+# Reconnecting clients are replayed what they missed from each page's last LIVE_REPLAY_EVENTS
+# events, kept LIVE_REPLAY_TTL seconds (comments.replay); beyond that they reload the page
+LIVE_REPLAY_EVENTS = 200
+LIVE_REPLAY_TTL = 600
 
 # Cache Configuration (Redis)
 CACHES = {
@@ -18,6 +18,7 @@ from django.contrib import admin
 from django.urls import path,include
 # comment_system/urls.py or wherever you included auth URLs
 from django.contrib.auth import views as auth_views
+from comments.metrics import metrics_view
 
 
 urlpatterns = [
@@ -27,5 +28,6 @@ urlpatterns = [
     path('accounts/signup/', include('comments.urls')),  # Include signup URL from comments app
     path('accounts/logout/', auth_views.LogoutView.as_view(), name='logout'),
     path('api/', include('comments.api_urls')),
+    path('metrics', metrics_view, name='metrics'),  # Prometheus scrape target
 
 ]
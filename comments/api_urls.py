@@ -1,10 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .api_views import PageViewSet, CommentViewSet
+from .api_views import PageViewSet, CommentViewSet, SearchViewSet
 
 router = DefaultRouter()
 router.register(r'pages', PageViewSet, basename='page')
 router.register(r'comments', CommentViewSet, basename='comment')
+router.register(r'search', SearchViewSet, basename='search')
 
 urlpatterns = [
     path('', include(router.urls)),
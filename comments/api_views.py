@@ -1,45 +1,75 @@
-from rest_framework import viewsets, status, filters
+from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
-from django.db.models import Count, Q
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from django.db import transaction
+from django.db.models import F
 from .models import Page, Comment, Vote
 from .serializers import (
-    PageSerializer, CommentSerializer, CommentCreateSerializer, VoteSerializer
+    PageSerializer, CommentSerializer, CommentCreateSerializer, CommentUpdateSerializer, VoteSerializer,
+    ThreadedCommentSerializer, SearchResultSerializer
 )
+from . import metrics, search
+from .broadcasts import publish_comment_change, publish_new_comment
+from .conditional import ConditionalResponseMixin
+from .pagination import KeysetPagination
+from .threads import link_replies, load_ancestors, load_subtree
+from .votes import cast_vote
 
 
-class PageViewSet(viewsets.ReadOnlyModelViewSet):
+class PageViewSet(ConditionalResponseMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing pages/posts.
-    GET /api/pages/ - List all pages
+    GET /api/pages/ - List all pages (?ordering=hot for the hottest first)
     GET /api/pages/{id}/ - Get specific page
-    GET /api/pages/{id}/comments/ - Get all comments for a page
+    GET /api/pages/{id}/comments/ - Get a cursor page of the nested comment tree for a page
     """
     queryset = Page.objects.all()
     serializer_class = PageSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.query_params.get('ordering') == 'hot':
+            queryset = queryset.order_by('-hot_score', '-id')
+        return queryset
+    
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(
+            request,
+            self.page_etag(request, kwargs['pk']),
+            lambda: super(PageViewSet, self).retrieve(request, *args, **kwargs)
+        )
+    
     @action(detail=True, methods=['get'])
     def comments(self, request, pk=None):
-        """Get all top-level comments for a page"""
+        """Get a cursor page of top-level comments with replies nested up to ?depth=N levels"""
+        return self.conditional_response(
+            request, self.page_etag(request, pk), lambda: self._comments(request)
+        )
+    
+    def _comments(self, request):
         page = self.get_object()
-        comments = Comment.objects.filter(
-            page=page, 
+        try:
+            max_depth = int(request.query_params['depth'])
+        except (KeyError, ValueError):
+            max_depth = None
+        
+        top_level = Comment.objects.filter(
+            page=page,
             parent__isnull=True,
             is_deleted=False
-        ).annotate(
-            upvotes=Count('votes', filter=Q(votes__vote_type=1)),
-            downvotes=Count('votes', filter=Q(votes__vote_type=-1)),
-            net_votes=Count('votes', filter=Q(votes__vote_type=1)) - 
-                      Count('votes', filter=Q(votes__vote_type=-1))
-        ).order_by('-created_at')
+        ).select_related('author')
         
-        serializer = CommentSerializer(comments, many=True, context={'request': request})
-        return Response(serializer.data)
+        paginator = KeysetPagination()
+        roots = paginator.paginate_queryset(top_level, request, view=self)
+        comments = link_replies(roots, max_depth=max_depth, ordering=(paginator.ordering[0], 'created_at'))
+        serializer = ThreadedCommentSerializer(comments, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
 
 
-class CommentViewSet(viewsets.ModelViewSet):
+class CommentViewSet(ConditionalResponseMixin, viewsets.ModelViewSet):
     """
     API endpoint for comments.
     GET /api/comments/ - List all comments
@@ -48,20 +78,18 @@ class CommentViewSet(viewsets.ModelViewSet):
     PUT/PATCH /api/comments/{id}/ - Update comment
     DELETE /api/comments/{id}/ - Delete comment
     GET /api/comments/{id}/replies/ - Get replies to a comment
+    GET /api/comments/{id}/subtree/?depth=N - Get a comment with its nested replies
+    GET /api/comments/{id}/ancestors/ - Get the parent chain of a comment
     POST /api/comments/{id}/vote/ - Vote on a comment
     """
     permission_classes = [IsAuthenticatedOrReadOnly]
-    filter_backends = [filters.OrderingFilter]
-    ordering_fields = ['created_at', 'net_votes']
-    ordering = ['-created_at']
+    # Cursor pagination on (created_at, id), (score, id) or (hot_score, id); ?ordering= picks the key
+    pagination_class = KeysetPagination
     
     def get_queryset(self):
-        queryset = Comment.objects.filter(is_deleted=False).annotate(
-            upvotes=Count('votes', filter=Q(votes__vote_type=1)),
-            downvotes=Count('votes', filter=Q(votes__vote_type=-1)),
-            net_votes=Count('votes', filter=Q(votes__vote_type=1)) - 
-                      Count('votes', filter=Q(votes__vote_type=-1))
-        )
+        # net_votes is the stored, indexed score column rather than an aggregate; reply
+        # counts are fetched for the returned page only (CommentListSerializer)
+        queryset = Comment.objects.filter(is_deleted=False).select_related('author').annotate(net_votes=F('score'))
         
         # Filter by page if provided
         page_id = self.request.query_params.get('page', None)
@@ -77,13 +105,31 @@ class CommentViewSet(viewsets.ModelViewSet):
         
         return queryset
     
+    def list(self, request, *args, **kwargs):
+        # Only a single-page listing has a cheap change marker to validate against
+        page_id = request.query_params.get('page')
+        etag = self.page_etag(request, page_id) if page_id else None
+        return self.conditional_response(
+            request, etag, lambda: super(CommentViewSet, self).list(request, *args, **kwargs)
+        )
+    
     def get_serializer_class(self):
         if self.action == 'create':
             return CommentCreateSerializer
+        if self.action in ('update', 'partial_update'):
+            return CommentUpdateSerializer
         return CommentSerializer
     
+    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        comment = serializer.save(author=self.request.user)
+        publish_new_comment(comment)
+        metrics.COMMENT_WRITES.labels('created', 'api').inc()
+
+    @transaction.atomic
+    def perform_update(self, serializer):
+        publish_comment_change(serializer.save())
+        metrics.COMMENT_WRITES.labels('edited', 'api').inc()
     
     def update(self, request, *args, **kwargs):
         comment = self.get_object()
@@ -102,7 +148,10 @@ class CommentViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
         comment.is_deleted = True
-        comment.save()
+        with transaction.atomic():
+            comment.save()
+            publish_comment_change(comment)
+        metrics.COMMENT_WRITES.labels('deleted', 'api').inc()
         return Response(status=status.HTTP_204_NO_CONTENT)
     
     @action(detail=True, methods=['get'])
@@ -112,46 +161,103 @@ class CommentViewSet(viewsets.ModelViewSet):
         replies = Comment.objects.filter(
             parent=parent_comment,
             is_deleted=False
-        ).annotate(
-            upvotes=Count('votes', filter=Q(votes__vote_type=1)),
-            downvotes=Count('votes', filter=Q(votes__vote_type=-1)),
-            net_votes=Count('votes', filter=Q(votes__vote_type=1)) - 
-                      Count('votes', filter=Q(votes__vote_type=-1))
-        ).order_by('created_at')
+        ).select_related('author').annotate(net_votes=F('score')).order_by('created_at')
         
         serializer = CommentSerializer(replies, many=True, context={'request': request})
         return Response(serializer.data)
     
+    @action(detail=True, methods=['get'])
+    def subtree(self, request, pk=None):
+        """Get a comment with all its replies nested, up to ?depth=N levels below it"""
+        comment = self.get_object()
+        try:
+            max_depth = int(request.query_params['depth'])
+        except (KeyError, ValueError):
+            max_depth = None
+        
+        root = load_subtree(comment, max_depth=max_depth)
+        serializer = ThreadedCommentSerializer(root, context={'request': request})
+        return Response(serializer.data)
+    
+    @action(detail=True, methods=['get'])
+    def ancestors(self, request, pk=None):
+        """Get the chain of parent comments, from the top-level comment down"""
+        comment = self.get_object()
+        ancestors = load_ancestors(comment)
+        serializer = CommentSerializer(ancestors, many=True, context={'request': request})
+        return Response(serializer.data)
+    
     @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
     def vote(self, request, pk=None):
         """
         Vote on a comment.
-        Body: {"vote_type": 1} for upvote, {"vote_type": -1} for downvote
+        Body: {"vote_type": 1} or {"vote_type": "up"} for upvote,
+              {"vote_type": -1} or {"vote_type": "down"} for downvote.
+        Voting the same way again removes the vote.
         """
         comment = self.get_object()
-        vote_type = request.data.get('vote_type')
         
-        if vote_type not in [1, -1]:
+        try:
+            result = cast_vote(request.user, comment, request.data.get('vote_type'))
+        except ValueError:
             return Response(
-                {'error': 'vote_type must be 1 (upvote) or -1 (downvote)'},
+                {'error': 'vote_type must be 1/"up" (upvote) or -1/"down" (downvote)'},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        metrics.VOTES.labels(result.action, 'api').inc()
         
-        vote, created = Vote.objects.get_or_create(
-            user=request.user,
-            comment=comment,
-            defaults={'vote_type': vote_type}
+        return Response(
+            {
+                'status': f'vote {result.action}',
+                'user_vote': result.vote_type,
+                'upvotes': result.upvotes,
+                'downvotes': result.downvotes,
+                'net_votes': result.score,
+            },
+            status=status.HTTP_201_CREATED if result.action == 'added' else status.HTTP_200_OK
         )
-        
-        if not created:
-            if vote.vote_type == vote_type:
-                # Remove vote if clicking same button
-                vote.delete()
-                return Response({'status': 'vote removed'})
-            else:
-                # Change vote
-                vote.vote_type = vote_type
-                vote.save()
-                return Response({'status': 'vote changed'})
-        
-        return Response({'status': 'vote added'}, status=status.HTTP_201_CREATED)
\ No newline at end of file
+
+
+class SearchViewSet(viewsets.ViewSet):
+    """
+    API endpoint for full-text search over discussions and comments.
+    GET /api/search/?q=words - Best matches first, with <mark>ed highlights (?page=N, ?page_size=N)
+
+    Only the newest SEARCH_CANDIDATES matches are ranked; ``capped`` is true
+    when the query matched more, and older matches were left out.
+    """
+    permission_classes = [IsAuthenticatedOrReadOnly]
+    page_size = 20
+    max_page_size = 50
+
+    def _int_param(self, request, name, default, maximum=None):
+        try:
+            value = int(request.query_params[name])
+        except (KeyError, ValueError):
+            return default
+        if value < 1:
+            return default
+        return min(value, maximum) if maximum else value
+
+    def list(self, request):
+        query = request.query_params.get('q', '').strip()
+        page_number = self._int_param(request, 'page', 1)
+        page_size = self._int_param(request, 'page_size', self.page_size, self.max_page_size)
+        found = search.search(query, offset=(page_number - 1) * page_size, limit=page_size)
+
+        # Ranked pages have no total (counting every match would cost what ranking avoids), only next/previous
+        url = request.build_absolute_uri()
+        next_url = replace_query_param(url, 'page', page_number + 1) if found.has_next else None
+        if page_number == 1:
+            previous_url = None
+        elif page_number == 2:
+            previous_url = remove_query_param(url, 'page')
+        else:
+            previous_url = replace_query_param(url, 'page', page_number - 1)
+        return Response({
+            'query': query,
+            'next': next_url,
+            'previous': previous_url,
+            'capped': found.capped,
+            'results': SearchResultSerializer(found.results, many=True).data,
+        })
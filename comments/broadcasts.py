@@ -0,0 +1,195 @@
+"""
+Live events for the WebSocket groups served by comments.consumers.
+
+Events are not sent from here: they are written to the outbox
+(comments.outbox) in the writer's transaction and dispatched after commit, so
+a slow or unavailable channel layer never holds up a request.
+
+Vote updates are coalesced per comment: the first vote in a window schedules
+one event, later votes in the same window ride along, and the event carries
+the latest stored counters. A comment receiving hundreds of votes per second
+thus produces one event per window. The pending marker lives in the shared
+cache, so coalescing also holds across worker processes.
+
+New and changed comments are sent with their rendered, viewer-neutral HTML
+(the same fragment the thread cache stores), rendered once per change no
+matter how many viewers receive it, so clients splice it in instead of
+reloading.
+
+Likewise, every event is serialized once, by encode(): it carries the JSON
+text clients receive, and consumers forward it to each socket as is. Page
+events name their ``page``, so a client watching several pages over one
+socket (consumers.LiveConsumer) can tell them apart.
+"""
+import json
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.template.loader import render_to_string
+
+from . import fragment_cache, outbox
+from .models import Comment
+
+
+PAGE_GROUP_PREFIX = 'comments_page_'
+
+
+def page_group(page_id):
+    return f'{PAGE_GROUP_PREFIX}{page_id}'
+
+
+def group_page_id(group):
+    """The page a page_group() name is for, or None for other groups."""
+    if group.startswith(PAGE_GROUP_PREFIX) and group[len(PAGE_GROUP_PREFIX):].isdigit():
+        return int(group[len(PAGE_GROUP_PREFIX):])
+    return None
+
+
+def notifications_group(user_id):
+    return f'notifications_{user_id}'
+
+
+# Channel layer event type -> the message type clients see
+CLIENT_TYPES = {
+    'comment_message': 'new_comment',
+    'comment_update': 'comment_update',
+    'vote_update': 'vote_update',
+    'user_typing': 'typing',
+    'notification_message': 'notification',
+}
+
+
+def client_message(event):
+    """The message a WebSocket client receives for ``event``."""
+    message = {key: value for key, value in event.items() if key != 'type'}
+    return {'type': CLIENT_TYPES[event['type']], **message}
+
+
+def encode(event):
+    """``event`` with its client message serialized, ready to forward to any number of sockets."""
+    return {'type': event['type'], 'text': json.dumps(client_message(event))}
+
+
+def vote_update_event(page_id, comment_id, upvotes, downvotes, score):
+    return encode({
+        'type': 'vote_update',
+        'page': page_id,
+        'comment_id': comment_id,
+        'upvotes': upvotes,
+        'downvotes': downvotes,
+        'net_votes': score,
+    })
+
+
+class VoteUpdateCoalescer:
+    """Publish at most one ``vote_update`` per comment per ``window`` seconds, carrying the latest counts."""
+
+    key_prefix = 'vote_update_pending'
+
+    def __init__(self, window=None):
+        self._window = window
+
+    @property
+    def window(self):
+        if self._window is not None:
+            return self._window
+        return getattr(settings, 'VOTE_BROADCAST_WINDOW', 0.25)
+
+    def pending_key(self, comment_id):
+        return f'{self.key_prefix}:{comment_id}'
+
+    def publish(self, comment_id, page_id):
+        window = self.window
+        if window <= 0:
+            self.flush(comment_id, page_id)
+            return
+        # Whoever sets the marker owns the send; it expires on its own if that worker dies
+        if cache.add(self.pending_key(comment_id), 1, timeout=max(1, int(window * 10))):
+            timer = threading.Timer(window, self._flush_in_thread, args=(comment_id, page_id))
+            timer.daemon = True
+            timer.start()
+
+    def _flush_in_thread(self, comment_id, page_id):
+        try:
+            self.flush(comment_id, page_id)
+        finally:
+            # Timer threads are short-lived; don't leave their DB connections behind
+            connections.close_all()
+
+    def flush(self, comment_id, page_id):
+        # Clear the marker before reading, so a vote landing after the read schedules a new send
+        cache.delete(self.pending_key(comment_id))
+        # Read from the primary: a timer thread has no request pinning it, and a
+        # lagging replica would announce counts from before the votes
+        counts = Comment.objects.using('default').filter(pk=comment_id).values('upvotes', 'downvotes', 'score').first()
+        if counts is None:
+            return
+        outbox.publish(page_group(page_id), vote_update_event(
+            page_id, comment_id, counts['upvotes'], counts['downvotes'], counts['score'],
+        ))
+
+
+vote_updates = VoteUpdateCoalescer()
+
+
+def publish_vote_update(comment):
+    """Announce ``comment``'s counters; call inside the transaction that changed them."""
+    if vote_updates.window <= 0:
+        # Uncoalesced: the event rides in the vote's own transaction
+        outbox.enqueue(page_group(comment.page_id), vote_update_event(
+            comment.page_id, comment.pk, comment.upvotes, comment.downvotes, comment.score,
+        ))
+    else:
+        transaction.on_commit(lambda: vote_updates.publish(comment.pk, comment.page_id))
+
+
+def render_comment_fragment(comment):
+    """HTML for a single comment, as comment_display.html renders it inside a cached thread."""
+    # Replies are already on the client (or there are none yet); don't let the template query for them
+    comment.children = []
+    comment.hidden_replies = 0
+    return render_to_string('comments/comment_display.html', {
+        'comment': comment,
+        'csrf_placeholder': fragment_cache.CSRF_PLACEHOLDER,
+    })
+
+
+def publish_new_comment(comment):
+    """Announce a new comment to its page's viewers and, for a reply, to the parent's author."""
+    outbox.enqueue(page_group(comment.page_id), encode({
+        'type': 'comment_message',
+        'page': comment.page_id,
+        'comment': {
+            'id': comment.id,
+            'author': comment.author.username,
+            'content': comment.content,
+            'created_at': comment.created_at.isoformat(),
+            'parent_id': comment.parent_id,
+            'depth': comment.depth,
+            'html': render_comment_fragment(comment),
+        },
+    }))
+    parent = comment.parent
+    if parent is not None and parent.author_id != comment.author_id:
+        outbox.enqueue(notifications_group(parent.author_id), encode({
+            'type': 'notification_message',
+            'message': f'{comment.author.username} replied to your comment',
+            'comment_id': comment.id,
+            'page_id': comment.page_id,
+        }))
+
+
+def publish_comment_change(comment):
+    """Announce an edited or (soft-)deleted comment; clients swap in the new HTML."""
+    outbox.enqueue(page_group(comment.page_id), encode({
+        'type': 'comment_update',
+        'page': comment.page_id,
+        'comment': {
+            'id': comment.id,
+            'content': '' if comment.is_deleted else comment.content,
+            'is_deleted': comment.is_deleted,
+            'html': render_comment_fragment(comment),
+        },
+    }))
@@ -0,0 +1,439 @@
+"""
+A channel layer that delivers to local group members in process and crosses
+the network only for members on other nodes.
+
+RedisChannelLayer sends a group message through Redis once per member, even
+when every member is a consumer in the sending process. LocalFanoutChannelLayer
+keeps channels and group membership in process, like InMemoryChannelLayer,
+and group_send() puts the message straight onto local members' queues. Each
+*other* node (daphne process) with members in the group gets the message
+once, over a transport, and fans it out to its own members.
+
+Which nodes have members in which group is kept on the transport, sharded by
+page id: ``comments_page_{id}`` lives on shard ``id % len(shards)`` (other
+groups are hashed). Nodes mirror the membership of every shard from its
+announcements, so a broadcast to a page nobody else is watching never leaves
+the process. A node that stops listening is dropped from its groups the
+first time a message sent to it reaches nobody.
+
+    CHANNEL_LAYERS = {'default': {
+        'BACKEND': 'comments.channel_layers.LocalFanoutChannelLayer',
+        'CONFIG': {'shards': ['redis://10.0.0.1:6379/0', 'redis://10.0.0.2:6379/0']},
+    }}
+
+``memory://<name>`` shards are an in-process stand-in for Redis: layers in one
+process using the same name act as separate nodes (tests, benchmarks), and a
+single ``memory://`` shard is a complete single-node setup.
+
+Local members of a group share one copy of each message; like every consumer
+here, handlers must not modify the events they receive.
+"""
+import asyncio
+import logging
+import random
+import re
+import string
+import threading
+import time
+import weakref
+import zlib
+from copy import deepcopy
+from functools import partial
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+# broadcasts.page_group() names
+PAGE_GROUP = re.compile(r'comments_page_(\d+)$')
+RECONNECT_DELAY = 1.0
+
+
+def shard_index(group, shards):
+    """The shard holding ``group``'s membership: by page id for page groups, else by hash."""
+    match = PAGE_GROUP.match(group)
+    key = int(match.group(1)) if match else zlib.crc32(group.encode())
+    return key % shards
+
+
+def pack(data):
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def unpack(payload):
+    return msgpack.unpackb(payload, raw=False)
+
+
+class InMemoryTransport:
+    """A shard held in this process. Layers sharing one see each other as separate nodes."""
+
+    _named = {}
+    _named_lock = threading.Lock()
+
+    @classmethod
+    def named(cls, name):
+        with cls._named_lock:
+            return cls._named.setdefault(name, cls())
+
+    def __init__(self):
+        self.groups = {}        # group -> nodes with members
+        self.listeners = {}     # node -> callback(payload)
+        self.sent = 0           # payloads that crossed between nodes
+        self._lock = threading.Lock()
+
+    async def add_member(self, group, node):
+        with self._lock:
+            self.groups.setdefault(group, set()).add(node)
+
+    async def remove_member(self, group, node):
+        with self._lock:
+            nodes = self.groups.get(group)
+            if nodes is not None:
+                nodes.discard(node)
+                if not nodes:
+                    del self.groups[group]
+
+    async def members(self, group=None):
+        with self._lock:
+            if group is not None:
+                return set(self.groups.get(group, ()))
+            return {name: set(nodes) for name, nodes in self.groups.items()}
+
+    async def send(self, node, payload):
+        """Deliver ``payload`` to ``node``; False if no such node is listening."""
+        callback = self.listeners.get(node)
+        if callback is None:
+            return False
+        self.sent += 1
+        callback(payload)
+        return True
+
+    async def announce(self, payload):
+        for callback in list(self.listeners.values()):
+            callback(payload)
+
+    async def listen(self, node, callback, on_subscribe):
+        self.listeners[node] = callback
+        await on_subscribe()
+
+    async def close(self, node):
+        self.listeners.pop(node, None)
+
+
+class RedisTransport:
+    """A shard on a Redis server: membership in sets, messages over pub/sub."""
+
+    def __init__(self, url, prefix):
+        import redis.asyncio
+
+        self.redis = redis.asyncio
+        self.url = url
+        self.prefix = prefix
+        self._clients = weakref.WeakKeyDictionary()  # event loop -> client
+        self._listener = None
+
+    def _client(self):
+        # Connections belong to an event loop; senders such as the outbox thread run their own
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = self.redis.Redis.from_url(self.url)
+        return client
+
+    def _group_key(self, group):
+        return f'{self.prefix}:group:{group}'
+
+    def _inbox(self, node):
+        return f'{self.prefix}:node:{node}'
+
+    @property
+    def _announcements(self):
+        return f'{self.prefix}:membership'
+
+    async def add_member(self, group, node):
+        await self._client().sadd(self._group_key(group), node)
+
+    async def remove_member(self, group, node):
+        await self._client().srem(self._group_key(group), node)
+
+    async def members(self, group=None):
+        client = self._client()
+        if group is not None:
+            return {node.decode() for node in await client.smembers(self._group_key(group))}
+        start = len(self._group_key(''))
+        groups = {}
+        async for key in client.scan_iter(match=self._group_key('*'), count=500):
+            groups[key.decode()[start:]] = {node.decode() for node in await client.smembers(key)}
+        return groups
+
+    async def send(self, node, payload):
+        return await self._client().publish(self._inbox(node), payload) > 0
+
+    async def announce(self, payload):
+        await self._client().publish(self._announcements, payload)
+
+    async def listen(self, node, callback, on_subscribe):
+        ready = asyncio.get_running_loop().create_future()
+        self._listener = asyncio.create_task(self._listen(node, callback, on_subscribe, ready))
+        await ready
+
+    async def _listen(self, node, callback, on_subscribe, ready):
+        while True:
+            pubsub = self._client().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self._inbox(node), self._announcements)
+                # Membership may have changed while we weren't listening
+                await on_subscribe()
+                if not ready.done():
+                    ready.set_result(None)
+                async for message in pubsub.listen():
+                    callback(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not ready.done():
+                    ready.set_exception(e)
+                    return
+                logger.warning('Lost %s; resubscribing', self.url, exc_info=True)
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                await pubsub.aclose()
+
+    async def close(self, node):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+def transport(url, prefix):
+    scheme, _, rest = url.partition('://')
+    if scheme == 'memory':
+        return InMemoryTransport.named(f'{prefix}:{rest}')
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisTransport(url, prefix)
+    raise ImproperlyConfigured(f'Unknown channel layer shard {url!r}: use memory://<name> or redis://host:port/db')
+
+
+def channel_node(channel):
+    """The node a specific channel (``specific.<node>!<id>``) lives on; None for general channels."""
+    if '!' not in channel:
+        return None
+    return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+
+
+class LocalFanoutChannelLayer(BaseChannelLayer):
+    """Channel layer delivering in process, and once per other node; see the module docstring."""
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, shards=('memory://default',), prefix='channels', expiry=60, capacity=100,
+                 channel_capacity=None):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        if not shards:
+            raise ImproperlyConfigured('LocalFanoutChannelLayer needs at least one shard')
+        self.shards = [transport(url, prefix) for url in shards]
+        self.node = ''.join(random.choices(string.ascii_lowercase + string.digits, k=12))
+        self.channels = {}      # channel -> asyncio.Queue of (expires, message)
+        self.receivers = {}     # channel -> event loop its consumer receives on
+        self.groups = {}        # group -> {channel: joined at}
+        self.joined = set()     # groups this node is registered for on their shard
+        self.remote = [{} for _ in self.shards]  # per shard: group -> nodes with members
+        self._loop = None       # the event loop the shards' messages are received on
+        self._ready = None
+        self._membership_lock = None
+
+    # Local delivery
+
+    def _put(self, channel, message):
+        """Queue ``message`` for a local channel, from any thread; raises ChannelFull."""
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+        item = (time.time() + self.expiry, message)
+        loop = self.receivers.get(channel)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is None or loop is running or loop.is_closed():
+            try:
+                queue.put_nowait(item)
+            except asyncio.QueueFull:
+                raise ChannelFull(channel)
+        else:
+            # A queue's waiters may only be woken from their own loop
+            if queue.full():
+                raise ChannelFull(channel)
+            loop.call_soon_threadsafe(self._put_nowait, queue, item)
+
+    @staticmethod
+    def _put_nowait(queue, item):
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            pass
+
+    def _deliver_group(self, group, message):
+        for channel in list(self.groups.get(group, ())):
+            try:
+                self._put(channel, message)
+            except ChannelFull:
+                pass
+
+    # Shards
+
+    async def _listen(self):
+        """Start receiving from the shards on the running event loop, if none is yet."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not None and not self._loop.is_closed():
+            if self._loop is loop:
+                await self._ready.wait()
+            return
+        self._loop = loop
+        self._ready = asyncio.Event()
+        self._membership_lock = asyncio.Lock()
+        try:
+            for index, shard in enumerate(self.shards):
+                await shard.listen(self.node, partial(self._on_message, index), partial(self._resync, index))
+        except Exception:
+            self._loop = None
+            raise
+        finally:
+            self._ready.set()
+
+    @property
+    def _mirrored(self):
+        return self._loop is not None and not self._loop.is_closed()
+
+    async def _resync(self, index):
+        shard = self.shards[index]
+        for group in list(self.joined):
+            if shard_index(group, len(self.shards)) == index:
+                await shard.add_member(group, self.node)
+        self.remote[index] = await shard.members()
+
+    def _on_message(self, index, payload):
+        data = unpack(payload)
+        if 'op' in data:
+            nodes = self.remote[index].setdefault(data['g'], set())
+            if data['op'] == '+':
+                nodes.add(data['n'])
+            else:
+                nodes.discard(data['n'])
+                if not nodes:
+                    self.remote[index].pop(data['g'], None)
+        elif 'g' in data:
+            self._deliver_group(data['g'], data['m'])
+        else:
+            try:
+                self._put(data['c'], data['m'])
+            except ChannelFull:
+                pass
+
+    async def _announce(self, index, op, group, node):
+        shard = self.shards[index]
+        if op == '+':
+            await shard.add_member(group, node)
+        else:
+            await shard.remove_member(group, node)
+        await shard.announce(pack({'op': op, 'g': group, 'n': node}))
+
+    async def _update_membership(self, group):
+        """Register or drop this node for ``group`` on its shard, to match local membership."""
+        async with self._membership_lock:
+            present = bool(self.groups.get(group))
+            if present == (group in self.joined):
+                return
+            await self._announce(shard_index(group, len(self.shards)), '+' if present else '-', group, self.node)
+            if present:
+                self.joined.add(group)
+            else:
+                self.joined.discard(group)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        node = channel_node(channel)
+        if node is None or node == self.node:
+            self._put(channel, deepcopy(message))
+        else:
+            await self.shards[0].send(node, pack({'c': channel, 'm': message}))
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        await self._listen()
+        self.receivers[channel] = asyncio.get_running_loop()
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        finally:
+            if queue.empty():
+                self.channels.pop(channel, None)
+                self.receivers.pop(channel, None)
+
+    async def new_channel(self, prefix='specific.'):
+        suffix = ''.join(random.choices(string.ascii_letters, k=12))
+        return f'{prefix}{self.node}!{suffix}'
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._listen()
+        self.groups.setdefault(group, {})[channel] = time.time()
+        await self._update_membership(group)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        members = self.groups.get(group)
+        if members:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+        if group in self.joined:
+            await self._update_membership(group)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+        self._deliver_group(group, deepcopy(message))
+
+        index = shard_index(group, len(self.shards))
+        shard = self.shards[index]
+        # Without a listener (e.g. a process that only publishes) there's no mirror: ask the shard
+        nodes = self.remote[index].get(group, ()) if self._mirrored else await shard.members(group)
+        others = [node for node in nodes if node != self.node]
+        if not others:
+            return
+        payload = pack({'g': group, 'm': message})
+        for node in others:
+            if not await shard.send(node, payload):
+                logger.info('Dropping unreachable node %s from %s', node, group)
+                await self._announce(index, '-', group, node)
+
+    async def flush(self):
+        groups = list(self.joined)
+        self.channels = {}
+        self.receivers = {}
+        self.groups = {}
+        for group in groups:
+            await self._update_membership(group)
+
+    async def close(self):
+        await self.flush()
+        for shard in self.shards:
+            await shard.close(self.node)
+        self._loop = None
@@ -0,0 +1,92 @@
+"""
+Conditional GET support (ETag / If-None-Match) for discussion pages and the API.
+
+Validators come from a cheap per-page change marker, ``(thread_version,
+updated_at)``, read with one primary-key lookup, so an unchanged read is
+answered with a 304 before any thread query runs. The page HTML also embeds
+the page's live event sequence number (comments.replay, read in the same
+lookup) and the viewer's CSRF
+token, so those are part of its validator; while flashed messages are waiting
+to be shown it gets no validator at all.
+"""
+import hashlib
+
+from django.contrib.messages import get_messages
+from django.utils.cache import get_conditional_response
+
+from .models import Page
+
+
+def page_marker(request, page_id):
+    """A page's ``thread_version``, ``updated_at``, ``live_seq`` and ``comment_count``, or None if it doesn't exist.
+
+    The last two ride along for the page view, which would otherwise read them
+    separately. Memoized on the request so the view and the ETag check share one lookup.
+    """
+    markers = getattr(request, '_page_markers', None)
+    if markers is None:
+        markers = request._page_markers = {}
+    try:
+        page_id = int(page_id)
+    except (TypeError, ValueError):
+        return None
+    if page_id not in markers:
+        markers[page_id] = Page.objects.filter(pk=page_id).values_list(
+            'thread_version', 'updated_at', 'live_seq', 'comment_count', named=True,
+        ).first()
+    return markers[page_id]
+
+
+def page_live_seq(request, page_id):
+    """The page's current event sequence number (comments.replay), read with page_marker()."""
+    marker = page_marker(request, page_id)
+    return marker.live_seq if marker else 0
+
+
+def page_etag(request, page_id, *variant):
+    """Strong ETag for a page-scoped response; ``variant`` covers anything else the body depends on."""
+    marker = page_marker(request, page_id)
+    if marker is None:
+        return None
+    parts = [str(page_id), str(marker.thread_version), marker.updated_at.isoformat(), *map(str, variant)]
+    return '"%s"' % hashlib.md5(':'.join(parts).encode()).hexdigest()
+
+
+def viewer_variant(request):
+    """What a personalized response depends on besides the page: the user and the query string."""
+    user = getattr(request, 'user', None)
+    user_id = user.pk if user is not None and user.is_authenticated else 0
+    return (user_id, request.META.get('QUERY_STRING', ''))
+
+
+def page_detail_etag(request, page_id):
+    """etag_func for django.views.decorators.http.condition on page_detail."""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    marker = page_marker(request, page_id)
+    if marker is None:
+        return None
+    # Without a CSRF cookie yet the page issues a new token, and a 304 would drop
+    # messages (len() reads them without marking them shown)
+    csrf_secret = request.META.get('CSRF_COOKIE')
+    if not csrf_secret or len(get_messages(request)):
+        return None
+    seq = page_live_seq(request, int(page_id))
+    return page_etag(request, page_id, 'html', seq, csrf_secret, *viewer_variant(request))
+
+
+class ConditionalResponseMixin:
+    """DRF viewset helper: answer If-None-Match with 304, otherwise build the response and tag it."""
+
+    def page_etag(self, request, page_id):
+        return page_etag(request, page_id, 'api', request.accepted_renderer.format, *viewer_variant(request))
+
+    def conditional_response(self, request, etag, respond):
+        if etag is not None:
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                return not_modified
+        response = respond()
+        if etag is not None and response.status_code == 200:
+            response['ETag'] = etag
+        return response
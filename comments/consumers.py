@@ -1,14 +1,50 @@
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
+from . import metrics, replay
+from .broadcasts import client_message, notifications_group, page_group
 from .models import Comment, Page
+from .typing import tracker as typing_tracker
+
+
+def event_text(event):
+    """The JSON text for a channel layer event; serialized here only for events queued before encode()."""
+    text = event.get('text')
+    return text if text is not None else json.dumps(client_message(event))
+
+
+def parse_seq(value):
+    """A client's last-seen sequence number, or None if absent or malformed."""
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        return None
+    return value
+
+
+async def replay_page(consumer, page_id, seq):
+    """Send the page's events after ``seq``, or a ``resync`` frame if they are gone."""
+    texts = await database_sync_to_async(replay.since)(page_id, seq)
+    if texts is None:
+        latest = await database_sync_to_async(replay.current)(page_id)
+        await consumer.send(text_data=json.dumps({'type': 'resync', 'page': page_id, 'seq': latest}))
+        return
+    for text in texts:
+        await consumer.send(text_data=text)
+
+
+def scope_username(scope):
+    """The authenticated user's username, or None for anonymous sockets."""
+    user = scope.get('user')
+    if user is None or not user.is_authenticated:
+        return None
+    return user.username
 
 
 class CommentConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.page_id = self.scope['url_route']['kwargs']['page_id']
-        self.room_group_name = f'comments_page_{self.page_id}'
+        self.page_id = int(self.scope['url_route']['kwargs']['page_id'])
+        self.room_group_name = page_group(self.page_id)
 
         # Join room group
         await self.channel_layer.group_add(
@@ -18,6 +54,11 @@ class CommentConsumer(AsyncWebsocketConsumer):
 
         # IMPORTANT: Accept the connection
         await self.accept()
+        metrics.websocket_opened('comments', self.room_group_name)
+
+        # Typing snapshots for this page are published by one task per process
+        typing_tracker.join(self.page_id)
+        typing_tracker.ensure_running(self.page_id, self.channel_layer)
         
         # Send confirmation message
         await self.send(text_data=json.dumps({
@@ -31,6 +72,12 @@ class CommentConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        metrics.websocket_closed('comments', self.room_group_name)
+        if hasattr(self, 'page_id'):
+            typing_tracker.leave(self.page_id, self.typing_username())
+
+    def typing_username(self):
+        return scope_username(self.scope)
 
     async def receive(self, text_data):
         """Handle incoming WebSocket messages"""
@@ -39,40 +86,23 @@ class CommentConsumer(AsyncWebsocketConsumer):
             message_type = data.get('type')
 
             if message_type == 'typing':
-                # Broadcast typing indicator
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'user_typing',
-                        'username': data.get('username', 'Someone'),
-                        'is_typing': data.get('is_typing', False)
-                    }
-                )
+                # Recorded only; the tracker broadcasts an aggregated snapshot
+                username = self.typing_username()
+                if username:
+                    typing_tracker.update(self.page_id, username, bool(data.get('is_typing', False)))
+            elif message_type == 'resume':
+                # A reconnecting client catches up on what it missed
+                seq = parse_seq(data.get('since'))
+                if seq is not None:
+                    await replay_page(self, self.page_id, seq)
         except Exception as e:
             print(f"Error in receive: {e}")
 
-    async def comment_message(self, event):
-        """Send new comment to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'type': 'new_comment',
-            'comment': event['comment']
-        }))
-
-    async def vote_update(self, event):
-        """Send vote update to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'type': 'vote_update',
-            'comment_id': event['comment_id'],
-            'net_votes': event['net_votes']
-        }))
+    async def forward(self, event):
+        """Send a page event to WebSocket, as encoded once by its publisher"""
+        await self.send(text_data=event_text(event))
 
-    async def user_typing(self, event):
-        """Send typing indicator to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'username': event['username'],
-            'is_typing': event['is_typing']
-        }))
+    comment_message = comment_update = vote_update = user_typing = forward
 
 
 class NotificationConsumer(AsyncWebsocketConsumer):
@@ -88,6 +118,7 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
             await self.accept()
+            metrics.websocket_opened('notifications')
         else:
             # For testing: accept but don't add to group
             await self.accept()
@@ -103,12 +134,125 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.room_group_name,
                 self.channel_name
             )
+            metrics.websocket_closed('notifications')
 
     async def notification_message(self, event):
         """Send notification to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'type': 'notification',
-            'message': event['message'],
-            'comment_id': event.get('comment_id'),
-            'page_id': event.get('page_id')
-        }))
\ No newline at end of file
+        await self.send(text_data=event_text(event))
+
+
+def parse_page_id(value):
+    if isinstance(value, bool) or not str(value).isdigit():
+        return None
+    return int(value)
+
+
+class LiveConsumer(AsyncWebsocketConsumer):
+    """One socket for any number of pages plus the user's notifications.
+
+    Opening a socket per page (and another for notifications) pays the
+    handshake and the session/user lookup each time; here the client opens one
+    and manages its subscriptions with frames:
+
+        {"type": "subscribe", "page": 12}                  -> {"type": "subscribed", "page": 12}
+        {"type": "unsubscribe", "page": 12}                -> {"type": "unsubscribed", "page": 12}
+        {"type": "subscribe", "stream": "notifications"}   -> {"type": "subscribed", "stream": "notifications"}
+        {"type": "typing", "page": 12, "is_typing": true}
+
+    A subscribe frame may carry ``"since": <seq>``, the last sequence number
+    the client saw for the page; the events after it follow the acknowledgement
+    (or a ``resync`` frame, see comments.replay). Page events carry their
+    ``page``, and those sent through the outbox their ``seq``. A connection may follow at most
+    LIVE_MAX_PAGE_SUBSCRIPTIONS pages; refused or malformed frames get an
+    ``error`` frame with a ``code``.
+    """
+
+    async def connect(self):
+        self.pages = set()
+        self.notifications = None
+        await self.accept()
+        metrics.websocket_opened('live')
+        await self.send_frame('connection_established', max_pages=self.max_pages)
+
+    async def disconnect(self, close_code):
+        for page_id in list(getattr(self, 'pages', ())):
+            await self.unsubscribe_page(page_id)
+        if getattr(self, 'notifications', None):
+            await self.channel_layer.group_discard(self.notifications, self.channel_name)
+        metrics.websocket_closed('live')
+
+    @property
+    def max_pages(self):
+        return getattr(settings, 'LIVE_MAX_PAGE_SUBSCRIPTIONS', 20)
+
+    async def send_frame(self, type_, **fields):
+        await self.send(text_data=json.dumps({'type': type_, **fields}))
+
+    async def receive(self, text_data):
+        try:
+            frame = json.loads(text_data)
+        except ValueError:
+            frame = None
+        if not isinstance(frame, dict):
+            return await self.send_frame('error', code='bad_request')
+        kind = frame.get('type')
+        if kind in ('subscribe', 'unsubscribe'):
+            if frame.get('stream') == 'notifications':
+                return await self.follow_notifications(kind == 'subscribe')
+            page_id = parse_page_id(frame.get('page'))
+            if page_id is None:
+                return await self.send_frame('error', code='bad_request', request=kind)
+            if kind == 'subscribe':
+                return await self.subscribe_page(page_id, parse_seq(frame.get('since')))
+            await self.unsubscribe_page(page_id)
+            return await self.send_frame('unsubscribed', page=page_id)
+        if kind == 'typing':
+            # Recorded only; the tracker broadcasts an aggregated snapshot
+            page_id = parse_page_id(frame.get('page'))
+            username = scope_username(self.scope)
+            if page_id in self.pages and username:
+                typing_tracker.update(page_id, username, bool(frame.get('is_typing', False)))
+            return
+        await self.send_frame('error', code='unknown_type')
+
+    async def subscribe_page(self, page_id, since=None):
+        if page_id not in self.pages:
+            if len(self.pages) >= self.max_pages:
+                return await self.send_frame('error', code='subscription_limit', page=page_id, limit=self.max_pages)
+            self.pages.add(page_id)
+            group = page_group(page_id)
+            await self.channel_layer.group_add(group, self.channel_name)
+            metrics.group_joined(group)
+            typing_tracker.join(page_id)
+            typing_tracker.ensure_running(page_id, self.channel_layer)
+        await self.send_frame('subscribed', page=page_id)
+        if since is not None:
+            # Joined first, so nothing falls between the replay and live events
+            await replay_page(self, page_id, since)
+
+    async def unsubscribe_page(self, page_id):
+        if page_id not in self.pages:
+            return
+        self.pages.discard(page_id)
+        group = page_group(page_id)
+        await self.channel_layer.group_discard(group, self.channel_name)
+        metrics.group_left(group)
+        typing_tracker.leave(page_id, scope_username(self.scope))
+
+    async def follow_notifications(self, follow):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            return await self.send_frame('error', code='auth_required', stream='notifications')
+        if follow and not self.notifications:
+            self.notifications = notifications_group(user.id)
+            await self.channel_layer.group_add(self.notifications, self.channel_name)
+        elif not follow and self.notifications:
+            await self.channel_layer.group_discard(self.notifications, self.channel_name)
+            self.notifications = None
+        await self.send_frame('subscribed' if follow else 'unsubscribed', stream='notifications')
+
+    async def forward(self, event):
+        """Send a page event or notification to WebSocket, as encoded once by its publisher"""
+        await self.send(text_data=event_text(event))
+
+    comment_message = comment_update = vote_update = user_typing = notification_message = forward
@@ -0,0 +1,106 @@
+"""
+Read-replica routing with read-your-writes pinning.
+
+ReplicaRouter sends writes to ``default`` and reads to one of the aliases in
+DATABASE_REPLICAS, chosen at random once per request (per query outside
+one), so a page isn't assembled from replicas that lag by different amounts. Reads stay on the primary when
+any of these hold:
+
+* they run inside a transaction on the primary (a write's own reads, and
+  SELECT ... FOR UPDATE);
+* the model must never lag (PRIMARY_MODELS: the outbox claims rows it has
+  just updated, and a session written at login must be found next request);
+* the current request has written, or the client wrote within the last
+  READ_YOUR_WRITES_WINDOW seconds, so its own post, edit or vote never looks
+  missing.
+
+The last needs PrimaryPinMiddleware, which marks a writing request's response
+with a short-lived cookie and pins the client's requests while it lasts.
+Clients that don't keep cookies (e.g. API scripts using Basic auth) are pinned
+only for the rest of the request that wrote. With no replicas configured
+every query goes to ``default``, as before.
+"""
+import contextvars
+import random
+
+from django.conf import settings
+from django.db import connections
+
+PRIMARY = 'default'
+PRIMARY_MODELS = {'comments.outboxevent', 'sessions.session'}
+PIN_COOKIE = 'db_pin'
+
+_request_state = contextvars.ContextVar('db_routing', default=None)
+
+
+class RoutingState:
+    """Per-request routing: ``pinned`` reads go to the primary; ``wrote`` is set by any write.
+
+    ``replica`` is the alias this request reads from, picked on its first read.
+    """
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+        self.replica = None
+
+
+def replica_aliases():
+    return getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+def reads_from_primary():
+    """Whether reads in the current context must see the primary's latest writes."""
+    state = _request_state.get()
+    if state is not None and (state.pinned or state.wrote):
+        return True
+    return connections[PRIMARY].in_atomic_block
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = replica_aliases()
+        if not replicas or model._meta.label_lower in PRIMARY_MODELS or reads_from_primary():
+            return PRIMARY
+        state = _request_state.get()
+        if state is None:
+            return random.choice(replicas)
+        if state.replica not in replicas:
+            state.replica = random.choice(replicas)
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        databases = {PRIMARY, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class PrimaryPinMiddleware:
+    """Pin a client's reads to the primary for READ_YOUR_WRITES_WINDOW seconds after it writes.
+
+    Goes above SessionMiddleware, so a session saved on the way out counts as
+    a write.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+        token = _request_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_state.reset(token)
+        if state.wrote and replica_aliases():
+            window = getattr(settings, 'READ_YOUR_WRITES_WINDOW', 5)
+            response.set_cookie(PIN_COOKIE, '1', max_age=window, httponly=True, samesite='Lax')
+        return response
@@ -34,6 +34,8 @@ class CommentForm(forms.ModelForm):
     
     def __init__(self, *args, **kwargs):
         parent_id = kwargs.pop('parent_id', None)
+        # The page the comment is posted to; a reply's parent must be on it
+        self.page = kwargs.pop('page', None)
         super().__init__(*args, **kwargs)
         if parent_id:
             self.fields['parent_id'].initial = str(parent_id)
@@ -45,9 +47,11 @@ class CommentForm(forms.ModelForm):
             try:
                 # Convert to int and get the Comment object
                 parent_comment = Comment.objects.get(id=int(parent_id))
-                return parent_comment  # Return the Comment object, not the ID
             except (ValueError, Comment.DoesNotExist):
                 raise forms.ValidationError("Parent comment not found.")
+            if self.page is not None and parent_comment.page_id != self.page.pk:
+                raise forms.ValidationError("Parent comment not found.")
+            return parent_comment  # Return the Comment object, not the ID
         return None
     
 class PageForm(forms.ModelForm):
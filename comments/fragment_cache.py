@@ -0,0 +1,79 @@
+"""
+Cache for rendered comment-thread HTML and the homepage listing.
+
+Fragments are keyed by the page's ``thread_version``, which Comment.save() and
+vote counter updates bump, so a write simply makes old fragments unreachable.
+Fragments are rendered without any viewer: the CSRF token and viewer state
+(own votes, author-only buttons) are applied on top by the page view, so one
+entry serves every user.
+
+The homepage listing is keyed by a global version kept in the cache itself,
+bumped after any page or comment activity commits.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+FRAGMENT_TTL = getattr(settings, 'CACHE_TTL', 900)
+HITS_KEY = 'thread_fragment:hits'
+MISSES_KEY = 'thread_fragment:misses'
+HOMEPAGE_VERSION_KEY = 'homepage_listing:version'
+
+# Rendered in place of {% csrf_token %}'s value; swapped for the viewer's token on output
+CSRF_PLACEHOLDER = '__CSRF_TOKEN__'
+
+
+def fragment_key(page_id, version, *variant):
+    return ':'.join(['thread_fragment', str(page_id), str(version), *map(str, variant)])
+
+
+def homepage_key(*variant):
+    version = cache.get_or_set(HOMEPAGE_VERSION_KEY, 1, timeout=None)
+    return ':'.join(['homepage_listing', str(version), *map(str, variant)])
+
+
+def invalidate_homepage():
+    _count(HOMEPAGE_VERSION_KEY)
+
+
+def _count(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Counter missing or evicted; start it again
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def get_or_render(key, render, counted=True):
+    """Return the cached entry for ``key``, calling ``render()`` to build and store it on a miss.
+
+    ``counted`` entries feed the hit/miss statistics (thread fragments only).
+    """
+    entry = cache.get(key)
+    metrics.cache_lookup(key.split(':', 1)[0], entry is not None)
+    if entry is not None:
+        if counted:
+            _count(HITS_KEY)
+        return entry
+    if counted:
+        _count(MISSES_KEY)
+    entry = render()
+    cache.set(key, entry, timeout=FRAGMENT_TTL)
+    return entry
+
+
+def stats():
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / total if total else 0.0,
+    }
+
+
+def reset_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
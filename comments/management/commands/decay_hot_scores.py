@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from comments import fragment_cache, ranking
+from comments.models import Comment, Page
+
+BATCH_SIZE = 500
+
+
+def batches(queryset):
+    """Yield the rows of ``queryset`` in primary key order, BATCH_SIZE at a time, each batch a fresh query."""
+    last = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last).order_by('pk')[:BATCH_SIZE])
+        if not batch:
+            return
+        yield batch
+        last = batch[-1].pk
+
+
+def redecay(queryset, points, now):
+    """Recompute hot_score for every row of ``queryset`` with a non-zero score.
+
+    Each batch is written in its own transaction, so the SQLite write lock is
+    held for one batch at a time rather than the whole run. Returns
+    (updated, cooled, changed): the counts, and the changed rows' page ids.
+    """
+    updated = cooled = 0
+    changed = set()
+    for batch in batches(queryset.filter(~Q(hot_score=0))):
+        for obj in batch:
+            # hot_score() is 0 for rows past the horizon
+            obj.hot_score = ranking.hot_score(points(obj), obj.created_at, now)
+        with transaction.atomic():
+            queryset.model.objects.bulk_update(batch, ['hot_score'])
+        went_cold = sum(obj.hot_score == 0 for obj in batch)
+        cooled += went_cold
+        updated += len(batch) - went_cold
+        changed.update(obj.page_id if isinstance(obj, Comment) else obj.pk for obj in batch)
+    return updated, cooled, changed
+
+
+class Command(BaseCommand):
+    help = 'Re-apply time decay to the stored hot scores of comments and discussions; run periodically'
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        comment_counts = redecay(
+            Comment.objects.only('id', 'page_id', 'score', 'reply_count', 'created_at', 'hot_score'),
+            lambda c: ranking.comment_points(c.score, c.reply_count), now,
+        )
+        page_counts = redecay(
+            Page.objects.only('id', 'hot_points', 'created_at', 'hot_score'), lambda p: p.hot_points, now,
+        )
+        # Hot-sorted threads and listings are cached per thread version: bump it for
+        # pages whose comments were re-ranked and for pages whose own score changed
+        page_ids = sorted(comment_counts[2] | page_counts[2])
+        for start in range(0, len(page_ids), BATCH_SIZE):
+            Page.objects.filter(pk__in=page_ids[start:start + BATCH_SIZE]).update(
+                thread_version=F('thread_version') + 1,
+            )
+        fragment_cache.invalidate_homepage()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Re-decayed {comment_counts[0]} comments and {page_counts[0]} discussions '
+            f'({comment_counts[1]} comments and {page_counts[1]} discussions went cold).'
+        ))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from comments import outbox
+
+
+class Command(BaseCommand):
+    help = 'Send pending live events from the outbox to the channel layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Send what is due now and exit')
+        parser.add_argument('--interval', type=float, default=0.5, help='Seconds between polls (default 0.5)')
+        parser.add_argument('--batch-size', type=int, default=outbox.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['once']:
+            sent = outbox.dispatch_all(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'Sent {sent} event(s).'))
+            return
+        self.stdout.write(f"Dispatching outbox events every {options['interval']}s (Ctrl+C to stop)")
+        try:
+            while True:
+                outbox.dispatch_all(options['batch_size'])
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
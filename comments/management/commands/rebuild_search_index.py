@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from comments import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index from all discussions and comments'
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The search index is SQLite FTS5; other databases search without one.')
+        with transaction.atomic():
+            indexed = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} discussion(s) and comment(s).'))
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from comments import fragment_cache, ranking
+from comments.models import Comment, Page, Vote
+
+
+def vote_count_subquery(vote_type):
+    return Coalesce(
+        Subquery(
+            Vote.objects.filter(comment=OuterRef('pk'), vote_type=vote_type)
+            .values('comment')
+            .annotate(c=Count('pk'))
+            .values('c')
+        ),
+        Value(0),
+    )
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the stored upvotes/downvotes/score counters on comments from Vote rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page', type=int, help='Only rebuild comments on this page id')
+
+    def handle(self, *args, **options):
+        comments = Comment.objects.all()
+        if options['page']:
+            comments = comments.filter(page_id=options['page'])
+
+        now = timezone.now()
+        with transaction.atomic():
+            drifted = list(comments.annotate(
+                real_up=vote_count_subquery('up'),
+                real_down=vote_count_subquery('down'),
+            ).filter(
+                ~Q(upvotes=F('real_up'))
+                | ~Q(downvotes=F('real_down'))
+                | ~Q(score=F('real_up') - F('real_down'))
+            ).only('id', 'page_id', 'score', 'reply_count', 'created_at'))
+
+            # Net score change per page, for the pages' hot points
+            shifts = {}
+            for comment in drifted:
+                score = comment.real_up - comment.real_down
+                shifts[comment.page_id] = shifts.get(comment.page_id, 0) + score - comment.score
+                comment.upvotes, comment.downvotes, comment.score = comment.real_up, comment.real_down, score
+                comment.hot_score = ranking.hot_score(
+                    ranking.comment_points(score, comment.reply_count), comment.created_at, now,
+                )
+            Comment.objects.bulk_update(drifted, ['upvotes', 'downvotes', 'score', 'hot_score'], batch_size=500)
+
+            # Cached threads and page ETags show the counts: bump every page touched
+            created = dict(Page.objects.filter(pk__in=shifts).values_list('pk', 'created_at'))
+            for page_id, shift in shifts.items():
+                changes = {'thread_version': F('thread_version') + 1}
+                if shift and page_id in created:
+                    points = F('hot_points') + shift
+                    changes.update(hot_points=points, hot_score=ranking.hot_expression(points, created[page_id], now))
+                Page.objects.filter(pk=page_id).update(**changes)
+            if shifts:
+                transaction.on_commit(fragment_cache.invalidate_homepage)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt vote counters for {comments.count()} comments ({len(drifted)} had drifted).'
+        ))
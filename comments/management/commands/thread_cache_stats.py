@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from comments import fragment_cache
+
+
+class Command(BaseCommand):
+    help = 'Show hit/miss counters for the rendered comment-thread cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        stats = fragment_cache.stats()
+        self.stdout.write(
+            f"hits: {stats['hits']}  misses: {stats['misses']}  hit ratio: {stats['hit_ratio']:.1%}"
+        )
+        if options['reset']:
+            fragment_cache.reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
@@ -0,0 +1,256 @@
+"""
+In-process metrics, served at /metrics in the Prometheus text format.
+
+A small registry of counters, gauges and histograms, each sample keyed by its
+label values. Recording is a dict lookup and an addition under a lock, cheap
+enough to leave on in production. Values are per process: with several
+workers, scrape each one (or aggregate in Prometheus).
+
+    http_request_duration_seconds{view,method,status}   request latency by URL name
+    http_request_db_queries{view}                       SQL statements per request
+    cache_lookups_total{cache,result}                   page object / fragment cache hits and misses
+    websocket_connections{consumer}                     open sockets per consumer
+    websocket_group_connections{group}                  sockets subscribed to each page group
+    channel_group_sends_total{type,result}              group_send calls by event type
+    channel_group_send_duration_seconds{type}           group_send latency
+    comment_writes_total{action,via}                    comments created, edited and deleted
+    votes_total{action,via}                             votes added, removed and changed
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from django.http import HttpResponse
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **labels):
+        if labels:
+            values = tuple(labels[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(tuple(str(value) for value in values), None)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """Lines of the text exposition format for this metric."""
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for values, child in sorted(self._children.copy().items()):
+            yield from child.samples(self.name, _labels(self.labelnames, values), self.labelnames, values)
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+            return self.value
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels, labelnames, values):
+        yield f'{name}{labels} {_number(self.value)}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[slot] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labels, labelnames, values):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float('inf')), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_labels(labelnames, values, [("le", _number(float(bound)))])} {cumulative}'
+        yield f'{name}_sum{labels} {_number(self.sum)}'
+        yield f'{name}_count{labels} {self.count}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _Histogram(self.buckets)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.histogram(
+    'http_request_duration_seconds', 'HTTP request latency by URL name.', ['view', 'method', 'status'],
+)
+REQUEST_QUERIES = registry.histogram(
+    'http_request_db_queries', 'SQL statements per HTTP request by URL name.', ['view'], buckets=QUERY_BUCKETS,
+)
+CACHE_LOOKUPS = registry.counter('cache_lookups_total', 'Cache lookups by cache and result.', ['cache', 'result'])
+WEBSOCKET_CONNECTIONS = registry.gauge('websocket_connections', 'Open WebSocket connections by consumer.', ['consumer'])
+WEBSOCKET_GROUP_CONNECTIONS = registry.gauge(
+    'websocket_group_connections', 'WebSocket connections subscribed to each page group.', ['group'],
+)
+GROUP_SENDS = registry.counter('channel_group_sends_total', 'Channel layer group_send calls.', ['type', 'result'])
+GROUP_SEND_LATENCY = registry.histogram(
+    'channel_group_send_duration_seconds', 'Channel layer group_send latency.', ['type'],
+)
+COMMENT_WRITES = registry.counter('comment_writes_total', 'Comments created, edited and deleted.', ['action', 'via'])
+VOTES = registry.counter('votes_total', 'Votes cast, by what they did.', ['action', 'via'])
+
+
+def cache_lookup(cache_name, hit):
+    CACHE_LOOKUPS.labels(cache_name, 'hit' if hit else 'miss').inc()
+
+
+def group_joined(group):
+    WEBSOCKET_GROUP_CONNECTIONS.labels(group).inc()
+
+
+def group_left(group):
+    # Drop a group's series once it's empty, so closed pages don't accumulate
+    if WEBSOCKET_GROUP_CONNECTIONS.labels(group).dec() <= 0:
+        WEBSOCKET_GROUP_CONNECTIONS.remove(group)
+
+
+def websocket_opened(consumer, group=None):
+    WEBSOCKET_CONNECTIONS.labels(consumer).inc()
+    if group:
+        group_joined(group)
+
+
+def websocket_closed(consumer, group=None):
+    WEBSOCKET_CONNECTIONS.labels(consumer).dec()
+    if group:
+        group_left(group)
+
+
+async def group_send(channel_layer, group, event):
+    """channel_layer.group_send(), counted and timed by event type."""
+    event_type = event.get('type', '')
+    started = time.perf_counter()
+    try:
+        await channel_layer.group_send(group, event)
+    except Exception:
+        GROUP_SENDS.labels(event_type, 'error').inc()
+        raise
+    GROUP_SEND_LATENCY.labels(event_type).observe(time.perf_counter() - started)
+    GROUP_SENDS.labels(event_type, 'ok').inc()
+
+
+class MetricsMiddleware:
+    """Record each request's latency (and SQL count, when QueryStatsMiddleware runs inside) by URL name."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        # URL names, not paths, keep the label set small
+        view = (match.view_name if match else None) or 'unresolved'
+        REQUEST_LATENCY.labels(view, request.method, response.status_code).observe(time.perf_counter() - started)
+        stats = getattr(request, 'query_stats', None)
+        if stats is not None:
+            REQUEST_QUERIES.labels(view).observe(stats.count)
+        return response
+
+
+def metrics_view(request):
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
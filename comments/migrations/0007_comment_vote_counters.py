@@ -0,0 +1,58 @@
+# Generated by Django 5.1.7 on 2026-10-17 01:12
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def vote_count_subquery(Vote, vote_type):
+    return Coalesce(
+        Subquery(
+            Vote.objects.filter(comment=OuterRef('pk'), vote_type=vote_type)
+            .values('comment')
+            .annotate(c=Count('pk'))
+            .values('c')
+        ),
+        Value(0),
+    )
+
+
+def populate_vote_counters(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+    Vote = apps.get_model('comments', 'Vote')
+
+    # The API used to store 1/-1 in vote_type; normalize before counting
+    Vote.objects.filter(vote_type='1').update(vote_type='up')
+    Vote.objects.filter(vote_type='-1').update(vote_type='down')
+
+    Comment.objects.update(
+        upvotes=vote_count_subquery(Vote, 'up'),
+        downvotes=vote_count_subquery(Vote, 'down'),
+    )
+    Comment.objects.update(score=models.F('upvotes') - models.F('downvotes'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0006_comment_is_deleted'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='downvotes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='score',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='upvotes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_vote_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.1.7 on 2026-10-17 01:15
+
+from django.db import migrations, models
+
+PATH_STEP = 10
+
+
+def populate_paths(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+
+    parents = dict(Comment.objects.values_list('pk', 'parent_id'))
+    paths = {}
+
+    def path_of(pk):
+        # Iterative so arbitrarily deep threads don't hit the recursion limit
+        chain = []
+        while pk is not None and pk not in paths:
+            chain.append(pk)
+            pk = parents[pk]
+        prefix = paths.get(pk, '')
+        for node in reversed(chain):
+            prefix = paths[node] = prefix + f'{node:0{PATH_STEP}d}/'
+        return prefix
+
+    comments = list(Comment.objects.only('pk'))
+    for comment in comments:
+        comment.path = path_of(comment.pk)
+        comment.depth = comment.path.count('/') - 1
+    Comment.objects.bulk_update(comments, ['path', 'depth'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0007_comment_vote_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=2048),
+        ),
+        migrations.RunPython(populate_paths, migrations.RunPython.noop),
+    ]
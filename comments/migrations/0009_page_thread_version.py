@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 01:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0008_comment_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='thread_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
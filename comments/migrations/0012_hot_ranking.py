@@ -0,0 +1,104 @@
+# Generated by Django 5.1.7 on 2026-10-17 01:39
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+# The ranking formula as of this migration (see comments.ranking), frozen here
+# so later changes to the live module don't alter what the migration does
+GRAVITY = 1.8
+REPLY_WEIGHT = 2
+HORIZON = timedelta(days=7)
+
+
+def hot_score(points, created_at, now):
+    if now - created_at > HORIZON:
+        return 0.0
+    age_hours = max(0.0, (now - created_at).total_seconds() / 3600)
+    return points / (age_hours + 2) ** GRAVITY
+
+
+def populate_hot_ranking(apps, schema_editor):
+    Page = apps.get_model('comments', 'Page')
+    Comment = apps.get_model('comments', 'Comment')
+
+    Comment.objects.update(reply_count=Coalesce(
+        Subquery(
+            Comment.objects.filter(parent=OuterRef('pk'))
+            .values('parent')
+            .annotate(c=Count('pk'))
+            .values('c')
+        ),
+        Value(0),
+    ))
+    page_comments = Comment.objects.filter(page=OuterRef('pk')).values('page')
+    Page.objects.update(hot_points=(
+        Coalesce(Subquery(page_comments.annotate(s=Sum('score')).values('s')), Value(0))
+        + REPLY_WEIGHT * Coalesce(Subquery(page_comments.annotate(c=Count('pk')).values('c')), Value(0))
+        + 1
+    ))
+
+    # Only recent rows get a non-zero score
+    now = timezone.now()
+    cutoff = now - HORIZON
+    comments = list(Comment.objects.filter(created_at__gte=cutoff).only('score', 'reply_count', 'created_at'))
+    for comment in comments:
+        points = comment.score + REPLY_WEIGHT * comment.reply_count + 1
+        comment.hot_score = hot_score(points, comment.created_at, now)
+    Comment.objects.bulk_update(comments, ['hot_score'], batch_size=500)
+    pages = list(Page.objects.filter(created_at__gte=cutoff).only('hot_points', 'created_at'))
+    for page in pages:
+        page.hot_score = hot_score(page.hot_points, page.created_at, now)
+    Page.objects.bulk_update(pages, ['hot_score'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0011_outbox_event'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='hot_score',
+            field=models.FloatField(default=0.0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='hot_points',
+            field=models.IntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='hot_score',
+            field=models.FloatField(default=0.0, editable=False),
+        ),
+        migrations.RunPython(populate_hot_ranking, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(condition=models.Q(('is_deleted', False), ('parent__isnull', True)), fields=['page', '-hot_score', '-id'], name='comment_toplevel_hot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(condition=models.Q(('hot_score', 0), _negated=True), fields=['created_at'], name='comment_hot_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='page',
+            index=models.Index(fields=['-hot_score', '-id'], name='page_hot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='page',
+            index=models.Index(condition=models.Q(('hot_score', 0), _negated=True), fields=['created_at'], name='page_hot_live_idx'),
+        ),
+    ]
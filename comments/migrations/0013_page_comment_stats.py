@@ -0,0 +1,40 @@
+# Generated by Django 5.1.7 on 2026-10-17 01:42
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def populate_page_stats(apps, schema_editor):
+    Page = apps.get_model('comments', 'Page')
+    Comment = apps.get_model('comments', 'Comment')
+
+    page_comments = Comment.objects.filter(page=OuterRef('pk')).values('page')
+    Page.objects.update(
+        comment_count=Coalesce(
+            Subquery(page_comments.annotate(c=Count('pk', filter=Q(is_deleted=False))).values('c')),
+            Value(0),
+        ),
+        last_activity_at=Subquery(page_comments.annotate(latest=Max('updated_at')).values('latest')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0012_hot_ranking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='last_activity_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(populate_page_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.1.7 on 2026-10-17 02:10
+
+from django.db import migrations
+
+# The index as of this migration (see comments.search), frozen here so later
+# changes to the live module don't alter what the migration creates
+TABLE = 'comments_search'
+
+SCHEMA = [
+    f"CREATE VIRTUAL TABLE {TABLE} USING fts5(title, body, prefix='2 3', tokenize='unicode61 remove_diacritics 2')",
+    f"""CREATE TRIGGER {TABLE}_page_insert AFTER INSERT ON comments_page BEGIN
+        INSERT INTO {TABLE}(rowid, title, body) VALUES (new.id * 2, new.title, new.content);
+    END""",
+    f"""CREATE TRIGGER {TABLE}_page_update AFTER UPDATE OF title, content ON comments_page
+    WHEN old.title IS NOT new.title OR old.content IS NOT new.content BEGIN
+        UPDATE {TABLE} SET title = new.title, body = new.content WHERE rowid = new.id * 2;
+    END""",
+    f"""CREATE TRIGGER {TABLE}_page_delete AFTER DELETE ON comments_page BEGIN
+        DELETE FROM {TABLE} WHERE rowid = old.id * 2;
+    END""",
+    f"""CREATE TRIGGER {TABLE}_comment_insert AFTER INSERT ON comments_comment
+    WHEN NOT new.is_deleted BEGIN
+        INSERT INTO {TABLE}(rowid, title, body) VALUES (new.id * 2 + 1, '', new.content);
+    END""",
+    f"""CREATE TRIGGER {TABLE}_comment_update AFTER UPDATE OF content, is_deleted ON comments_comment
+    WHEN old.content IS NOT new.content OR old.is_deleted IS NOT new.is_deleted BEGIN
+        DELETE FROM {TABLE} WHERE rowid = old.id * 2 + 1;
+        INSERT INTO {TABLE}(rowid, title, body) SELECT new.id * 2 + 1, '', new.content WHERE NOT new.is_deleted;
+    END""",
+    f"""CREATE TRIGGER {TABLE}_comment_delete AFTER DELETE ON comments_comment BEGIN
+        DELETE FROM {TABLE} WHERE rowid = old.id * 2 + 1;
+    END""",
+]
+
+DROP_SCHEMA = [
+    *(f'DROP TRIGGER IF EXISTS {TABLE}_{name}' for name in (
+        'page_insert', 'page_update', 'page_delete', 'comment_insert', 'comment_update', 'comment_delete',
+    )),
+    f'DROP TABLE IF EXISTS {TABLE}',
+]
+
+
+def create_search_index(apps, schema_editor):
+    # FTS5 is SQLite-only; other backends use the LIKE fallback in comments.search
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in SCHEMA:
+            cursor.execute(statement)
+        cursor.execute(f'INSERT INTO {TABLE}(rowid, title, body) SELECT id * 2, title, content FROM comments_page')
+        cursor.execute(
+            f"INSERT INTO {TABLE}(rowid, title, body)"
+            f" SELECT id * 2 + 1, '', content FROM comments_comment WHERE NOT is_deleted"
+        )
+        cursor.execute(f"INSERT INTO {TABLE}({TABLE}) VALUES ('optimize')")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in DROP_SCHEMA:
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0013_page_comment_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
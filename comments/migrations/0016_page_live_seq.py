@@ -0,0 +1,44 @@
+# Generated by Django 5.1.7 on 2026-10-17 02:57
+
+from django.db import migrations, models
+
+# Adding a column makes SQLite rebuild comments_page, which drops the search
+# index's triggers on it (migration 0014); they are created again as they were
+PAGE_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS comments_search_page_insert AFTER INSERT ON comments_page BEGIN
+        INSERT INTO comments_search(rowid, title, body) VALUES (new.id * 2, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS comments_search_page_update AFTER UPDATE OF title, content ON comments_page
+    WHEN old.title IS NOT new.title OR old.content IS NOT new.content BEGIN
+        UPDATE comments_search SET title = new.title, body = new.content WHERE rowid = new.id * 2;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS comments_search_page_delete AFTER DELETE ON comments_page BEGIN
+        DELETE FROM comments_search WHERE rowid = old.id * 2;
+    END""",
+]
+
+
+def restore_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in PAGE_TRIGGERS:
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0015_outbox_event_seq'),
+    ]
+
+    operations = [
+        # On the way back the column's removal rebuilds the table again, so restore after it too
+        migrations.RunPython(migrations.RunPython.noop, restore_search_triggers),
+        migrations.AddField(
+            model_name='page',
+            name='live_seq',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
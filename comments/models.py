@@ -1,22 +1,76 @@
 # models.py
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from datetime import timedelta
 from django.utils import timezone
 from django.conf import settings
 
+from . import fragment_cache, ranking
+
 
 class Page(models.Model):
     title = models.CharField(max_length=200)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Bumped on every comment write or vote; keys the rendered-thread cache
+    thread_version = models.PositiveIntegerField(default=0, editable=False)
+    # Hot ranking (see comments.ranking): points from comment scores and comment
+    # count, and the stored, time-decayed score derived from them
+    hot_points = models.IntegerField(default=1, editable=False)
+    hot_score = models.FloatField(default=0.0, editable=False)
+    # Denormalized for listings: visible (not deleted) comments at any depth,
+    # and the time of the last comment write or vote (None until the first)
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+    last_activity_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Sequence number of the page's latest live event (comments.replay)
+    live_seq = models.PositiveBigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            self.hot_score = ranking.hot_score(self.hot_points, timezone.now())
+        super().save(*args, **kwargs)
+        transaction.on_commit(fragment_cache.invalidate_homepage)
+
+    @property
+    def last_active(self):
+        return self.last_activity_at or self.created_at
+
+    @classmethod
+    def bump_thread_version(cls, page_id):
+        cls.objects.filter(pk=page_id).update(thread_version=models.F('thread_version') + 1)
+
+    @classmethod
+    def record_activity(cls, page_id, hot_points=0, comments=0):
+        """A comment was written or voted on: update the page's stats in one UPDATE and drop cached renderings.
+
+        ``hot_points`` shifts the hot ranking and ``comments`` the visible comment count.
+        """
+        changes = {
+            'thread_version': models.F('thread_version') + 1,
+            'last_activity_at': timezone.now(),
+        }
+        if comments:
+            changes['comment_count'] = models.F('comment_count') + comments
+        if hot_points:
+            created_at = cls.objects.filter(pk=page_id).values_list('created_at', flat=True).first()
+            if created_at is not None:
+                points = models.F('hot_points') + hot_points
+                changes.update(hot_points=points, hot_score=ranking.hot_expression(points, created_at))
+        cls.objects.filter(pk=page_id).update(**changes)
+        transaction.on_commit(fragment_cache.invalidate_homepage)
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Discussions, hottest first (homepage ?sort=hot, /api/pages/?ordering=hot)
+            models.Index(fields=['-hot_score', '-id'], name='page_hot_idx'),
+            # Pages that still have a non-zero hot score to re-decay (decay_hot_scores)
+            models.Index(fields=['created_at'], condition=~models.Q(hot_score=0), name='page_hot_live_idx'),
+        ]
 
 class Comment(models.Model):
     page = models.ForeignKey(Page, on_delete=models.CASCADE, related_name='comments')
@@ -26,6 +80,23 @@ class Comment(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='replies')
 
+    # Denormalized vote counters, kept in sync by adjust_vote_counts() and
+    # rebuilt from Vote rows by `manage.py rebuild_vote_counts`.
+    upvotes = models.PositiveIntegerField(default=0)
+    downvotes = models.PositiveIntegerField(default=0)
+    score = models.IntegerField(default=0, db_index=True)
+
+    # Materialized path of zero-padded ids from the root down to this comment,
+    # e.g. "0000000004/0000000019/". A subtree is one range scan on this column.
+    path = models.CharField(max_length=2048, db_index=True, editable=False, default='')
+    depth = models.PositiveIntegerField(default=0, editable=False)
+
+    # Hot ranking (see comments.ranking). reply_count counts direct replies
+    # ever posted, including ones deleted later.
+    reply_count = models.PositiveIntegerField(default=0, editable=False)
+    hot_score = models.FloatField(default=0.0, editable=False)
+
+    PATH_STEP = 10  # digits per path segment
 
     # def get_replies(self):
     #     return self.replies.all().order_by('created_at')
@@ -34,6 +105,70 @@ class Comment(models.Model):
     def __str__(self):
         return f'Comment by {self.author.username} on {self.page.title}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored state so save() can tell a delete or restore from an edit
+        if 'is_deleted' in field_names:
+            instance._saved_is_deleted = instance.is_deleted
+        return instance
+
+    def _visible_change(self, creating):
+        """+1/-1/0: how this save changes the page's count of visible comments."""
+        if creating:
+            return 0 if self.is_deleted else 1
+        saved = getattr(self, '_saved_is_deleted', self.is_deleted)
+        if saved == self.is_deleted:
+            return 0
+        # Flip the flag conditionally first, so two concurrent deletes count once
+        if not Comment.objects.filter(pk=self.pk, is_deleted=saved).update(is_deleted=self.is_deleted):
+            return 0
+        return -1 if self.is_deleted else 1
+
+    def save(self, *args, **kwargs):
+        creating = self._state.adding
+        visible = self._visible_change(creating)
+        super().save(*args, **kwargs)
+        self._saved_is_deleted = self.is_deleted
+        if creating:
+            changes = {}
+            if not self.path:
+                # The path needs our own pk, so it can only be written after the insert
+                parent_path = self.parent.path if self.parent_id else ''
+                self.path = parent_path + self.path_segment(self.pk)
+                self.depth = self.path.count('/') - 1
+                changes.update(path=self.path, depth=self.depth)
+            self.hot_score = ranking.hot_score(ranking.comment_points(self.score, self.reply_count), self.created_at)
+            changes['hot_score'] = self.hot_score
+            Comment.objects.filter(pk=self.pk).update(**changes)
+            if self.parent_id:
+                self.parent.count_reply()
+        Page.record_activity(
+            self.page_id, hot_points=ranking.REPLY_WEIGHT if creating else 0, comments=visible,
+        )
+
+    def count_reply(self):
+        """Record a new direct reply: bump reply_count and the hot score it feeds."""
+        points = ranking.comment_points(models.F('score'), models.F('reply_count') + 1)
+        Comment.objects.filter(pk=self.pk).update(
+            reply_count=models.F('reply_count') + 1,
+            hot_score=ranking.hot_expression(points, self.created_at),
+        )
+
+    @classmethod
+    def path_segment(cls, pk):
+        return f'{pk:0{cls.PATH_STEP}d}/'
+
+    @classmethod
+    def subtree_filter(cls, path):
+        """Q for the comment at ``path`` and all its descendants, as a range on the path index."""
+        # '0' sorts right after '/', so this bound excludes siblings whose id shares our prefix
+        return models.Q(path__gte=path, path__lt=path[:-1] + '0')
+
+    def ancestor_ids(self):
+        """Ids of this comment's ancestors, root first, read from the path."""
+        return [int(segment) for segment in self.path.split('/')[:-2]]
+
     def is_parent(self):
         return self.parent is None
 
@@ -57,15 +192,23 @@ class Comment(models.Model):
 
     @property
     def upvote_count(self):
-        return self.votes.filter(vote_type='up').count()
+        return self.upvotes
 
     @property
     def downvote_count(self):
-        return self.votes.filter(vote_type='down').count()
+        return self.downvotes
 
-    @property
-    def score(self):
-        return self.upvote_count - self.downvote_count
+    def adjust_vote_counts(self, up=0, down=0):
+        """Atomically shift the stored counters and refresh them on this instance."""
+        score = models.F('score') + up - down
+        Comment.objects.filter(pk=self.pk).update(
+            upvotes=models.F('upvotes') + up,
+            downvotes=models.F('downvotes') + down,
+            score=score,
+            hot_score=ranking.hot_expression(ranking.comment_points(score, models.F('reply_count')), self.created_at),
+        )
+        self.refresh_from_db(fields=['upvotes', 'downvotes', 'score', 'hot_score'])
+        Page.record_activity(self.page_id, hot_points=up - down)
 
     is_deleted = models.BooleanField(default=False)  # NEW FIELD
 
@@ -82,6 +225,35 @@ class Comment(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        # Shaped after the hot queries; partial (is_deleted=False) where the backend supports it
+        indexes = [
+            # Top-level comments of a page, newest first (page_detail, PageViewSet.comments)
+            models.Index(
+                fields=['page', '-created_at', '-id'],
+                condition=models.Q(parent__isnull=True, is_deleted=False),
+                name='comment_toplevel_new_idx',
+            ),
+            # Top-level comments of a page, highest score first (?sort=top)
+            models.Index(
+                fields=['page', '-score', '-id'],
+                condition=models.Q(parent__isnull=True, is_deleted=False),
+                name='comment_toplevel_top_idx',
+            ),
+            # Top-level comments of a page, hottest first (?sort=hot, ?ordering=hot)
+            models.Index(
+                fields=['page', '-hot_score', '-id'],
+                condition=models.Q(parent__isnull=True, is_deleted=False),
+                name='comment_toplevel_hot_idx',
+            ),
+            # Comments that still have a non-zero hot score to re-decay (decay_hot_scores)
+            models.Index(fields=['created_at'], condition=~models.Q(hot_score=0), name='comment_hot_live_idx'),
+            # Visible replies of a comment in conversation order (CommentViewSet.replies)
+            models.Index(
+                fields=['parent', 'created_at'],
+                condition=models.Q(is_deleted=False),
+                name='comment_replies_idx',
+            ),
+        ]
 
 class Vote(models.Model):
     VOTE_TYPES = [
@@ -95,6 +267,41 @@ class Vote(models.Model):
 
     class Meta:
         unique_together = ('user', 'comment')
+        indexes = [
+            # Per-type vote counts for a comment (rebuild_vote_counts)
+            models.Index(fields=['comment', 'vote_type'], name='vote_comment_type_idx'),
+        ]
+
+    @staticmethod
+    def counter_delta(old_type, new_type):
+        """(up, down) change to Comment counters when a vote goes from old_type to new_type (None = no vote)."""
+        up = (new_type == 'up') - (old_type == 'up')
+        down = (new_type == 'down') - (old_type == 'down')
+        return up, down
 
     def __str__(self):
         return f'{self.user.username} {self.vote_type}d on comment {self.comment.id}'
+
+
+class OutboxEvent(models.Model):
+    """A channel-layer event waiting to be sent; written in the same transaction as the change it announces."""
+    group = models.CharField(max_length=100)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Not sent before this time: set on retry (backoff) and while a dispatcher holds the claim
+    available_at = models.DateTimeField(default=timezone.now)
+    claim = models.CharField(max_length=32, blank=True, default='')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    # Page events: the page's sequence number, assigned when written (comments.replay)
+    seq = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # Next batch of due events (comments.outbox.dispatch_pending)
+            models.Index(fields=['available_at', 'id'], name='outbox_available_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.payload.get("type")} -> {self.group}'
@@ -0,0 +1,173 @@
+"""
+Transactional outbox for WebSocket fan-out.
+
+Writers call ``enqueue()`` inside the transaction that makes the change, so an
+event exists exactly when the change committed, and the request never waits on
+the channel layer. After commit a dispatcher sends due events in batches and
+deletes them; a failed send is retried with exponential backoff. Delivery is
+at-least-once: a crash between sending and deleting repeats the event, which
+clients tolerate (new comments are de-duplicated by id, updates carry state).
+Page events get their sequence number as they are written, and a place in the
+page's replay buffer once committed (comments.replay).
+
+OUTBOX_DISPATCH picks who sends:
+
+* ``'thread'`` (default): one background thread per process, woken on commit
+  and polling every OUTBOX_POLL_INTERVAL seconds for retries;
+* ``'inline'``: right after commit, in the committing thread (tests);
+* ``'worker'``: nothing in-process; run ``manage.py dispatch_outbox``.
+"""
+import logging
+import threading
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, connections, transaction
+from django.utils import timezone
+
+from . import metrics, replay
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+# How long a dispatcher may hold claimed events before another may take them
+CLAIM_TIMEOUT = timedelta(seconds=30)
+MAX_BACKOFF = 60
+
+
+def enqueue(group, event):
+    """Record ``event`` for ``group``; it is sent once the current transaction commits."""
+    seq, event = replay.sequence(group, event)
+    OutboxEvent.objects.create(group=group, payload=event, seq=seq)
+    if seq is not None:
+        transaction.on_commit(lambda: replay.keep(group, seq, event))
+    transaction.on_commit(dispatcher.wake)
+
+
+def publish(group, event):
+    """enqueue() for code running outside a write transaction."""
+    with transaction.atomic():
+        enqueue(group, event)
+
+
+async def group_send(group, event):
+    await metrics.group_send(get_channel_layer(), group, event)
+
+
+async def _send_batch(messages):
+    """Send (group, event) pairs in order; return the exception (or None) for each."""
+    results = []
+    for group, event in messages:
+        try:
+            await group_send(group, event)
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(2 ** attempts, MAX_BACKOFF))
+
+
+def claim_batch(batch_size=BATCH_SIZE):
+    """Claim up to ``batch_size`` due events for this dispatcher and return them in id order."""
+    now = timezone.now()
+    due = OutboxEvent.objects.filter(available_at__lte=now)
+    ids = list(due.order_by('available_at', 'id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    # Only rows still due are claimed, so concurrent dispatchers split the batch instead of sharing it
+    due.filter(pk__in=ids).update(claim=token, available_at=now + CLAIM_TIMEOUT)
+    return list(OutboxEvent.objects.filter(claim=token).order_by('id'))
+
+
+def dispatch_pending(batch_size=BATCH_SIZE):
+    """Send one batch of due events; return how many were delivered."""
+    events = claim_batch(batch_size)
+    if not events:
+        return 0
+    results = async_to_sync(_send_batch)([(event.group, event.payload) for event in events])
+
+    sent = [event.pk for event, error in zip(events, results) if error is None]
+    OutboxEvent.objects.filter(pk__in=sent).delete()
+
+    max_attempts = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 10)
+    now = timezone.now()
+    for event, error in zip(events, results):
+        if error is None:
+            continue
+        event.attempts += 1
+        if event.attempts >= max_attempts:
+            logger.error('Dropping %s after %d attempts: %s', event, event.attempts, error)
+            event.delete()
+            continue
+        logger.warning('Sending %s failed (attempt %d): %s', event, event.attempts, error)
+        event.claim = ''
+        event.available_at = now + retry_delay(event.attempts)
+        event.last_error = repr(error)
+        event.save(update_fields=['attempts', 'claim', 'available_at', 'last_error'])
+    return len(sent)
+
+
+def dispatch_all(batch_size=BATCH_SIZE):
+    """Send batches until nothing is due; return the number delivered."""
+    total = 0
+    while True:
+        sent = dispatch_pending(batch_size)
+        total += sent
+        if sent < batch_size:
+            return total
+
+
+class Dispatcher:
+    """Per-process sender, woken on commit; see OUTBOX_DISPATCH."""
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def wake(self):
+        mode = getattr(settings, 'OUTBOX_DISPATCH', 'thread')
+        if mode == 'worker':
+            return
+        if mode == 'inline':
+            try:
+                dispatch_all()
+            except Exception:
+                # Events stay in the outbox and go out on the next dispatch
+                logger.exception('Outbox dispatch failed')
+            return
+        self._ensure_thread()
+        self._wakeup.set()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='outbox-dispatcher', daemon=True)
+                self._thread.start()
+
+    def run(self):
+        interval = getattr(settings, 'OUTBOX_POLL_INTERVAL', 1.0)
+        while True:
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            close_old_connections()
+            try:
+                dispatch_all()
+            except OperationalError:
+                # e.g. SQLite busy with a writer; the events are still there next round
+                logger.warning('Outbox dispatch deferred', exc_info=True)
+                connections.close_all()
+            except Exception:
+                logger.exception('Outbox dispatch failed')
+                connections.close_all()
+
+
+dispatcher = Dispatcher()
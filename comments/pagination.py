@@ -0,0 +1,218 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are addressed by the sort key of the last row seen instead of an OFFSET,
+so each request reads only the rows it returns and pages stay stable while new
+comments arrive. Cursors are opaque base64 tokens.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _encode_value(value):
+    # isoformat keeps full microsecond precision, which the keyset comparison needs
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def encode_cursor(values, reverse=False):
+    payload = json.dumps([int(reverse), [_encode_value(v) for v in values]], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return ``(values, reverse)`` for a cursor token, or raise InvalidCursor."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        reverse, values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return list(values), bool(reverse)
+    except (binascii.Error, ValueError, TypeError, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+
+
+class KeysetPage:
+    """One page of results, iterable like a Django ``Page``."""
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """Paginate ``queryset`` by ``ordering``, a tuple of fields ending in a unique one (e.g. ``('-created_at', '-id')``)."""
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.per_page = per_page
+        self.fields = [(name.lstrip('-'), name.startswith('-')) for name in self.ordering]
+
+    def _key(self, obj):
+        return [getattr(obj, name) for name, _ in self.fields]
+
+    def _parse(self, cursor):
+        """``(values, reverse)`` for a cursor, with values converted to the fields' types; raises InvalidCursor."""
+        values, reverse = decode_cursor(cursor)
+        if len(values) != len(self.fields):
+            raise InvalidCursor(cursor)
+        model = self.queryset.model
+        try:
+            return [model._meta.get_field(name).to_python(v) for (name, _), v in zip(self.fields, values)], reverse
+        except (ValidationError, TypeError, ValueError):
+            raise InvalidCursor(cursor)
+
+    def normalize(self, cursor):
+        """The canonical token for ``cursor``, or '' for an invalid one (get_page() serves the first page).
+
+        Cache keys use it, so equivalent or malformed cursors share one entry.
+        """
+        if not cursor:
+            return ''
+        try:
+            values, reverse = self._parse(cursor)
+        except InvalidCursor:
+            return ''
+        return encode_cursor(values, reverse)
+
+    def _after(self, values, reverse):
+        """Q matching rows that sort strictly after ``values`` (before them if ``reverse``)."""
+        # (a < x) OR (a = x AND b < y) OR ... for each field in turn
+        condition = Q()
+        for i, (name, descending) in enumerate(self.fields):
+            lookup = 'lt' if descending != reverse else 'gt'
+            step = Q(**{f'{name}__{lookup}': values[i]})
+            for j in range(i):
+                step &= Q(**{self.fields[j][0]: values[j]})
+            condition |= step
+        return condition
+
+    def page(self, cursor=None):
+        """Return the page after (or, for a reverse cursor, before) ``cursor``; raises InvalidCursor."""
+        queryset, reverse = self.queryset, False
+        if cursor:
+            values, reverse = self._parse(cursor)
+            try:
+                queryset = queryset.filter(self._after(values, reverse))
+            except (ValidationError, TypeError, ValueError):
+                raise InvalidCursor(cursor)
+
+        ordering = self.ordering
+        if reverse:
+            ordering = [name[1:] if name.startswith('-') else f'-{name}' for name in ordering]
+        rows = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if reverse:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, bool(cursor)
+
+        next_cursor = encode_cursor(self._key(rows[-1])) if rows and has_next else None
+        previous_cursor = encode_cursor(self._key(rows[0]), reverse=True) if rows and has_previous else None
+        return KeysetPage(rows, next_cursor, previous_cursor)
+
+    def get_page(self, cursor=None):
+        """Like page(), but an invalid cursor falls back to the first page."""
+        try:
+            return self.page(cursor)
+        except InvalidCursor:
+            return self.page(None)
+
+
+class KeysetPagination(BasePagination):
+    """
+    DRF keyset pagination. ``?ordering=`` picks one of ``orderings`` and
+    ``?cursor=`` continues from a ``next``/``previous`` link.
+    """
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    page_size_query_param = 'page_size'
+    page_size = api_settings.PAGE_SIZE or 20
+    max_page_size = 100
+    orderings = {
+        'created_at': ('created_at', 'id'),
+        '-created_at': ('-created_at', '-id'),
+        'score': ('score', 'id'),
+        '-score': ('-score', '-id'),
+        'net_votes': ('score', 'id'),
+        '-net_votes': ('-score', '-id'),
+        'hot': ('-hot_score', '-id'),
+        'hot_score': ('hot_score', 'id'),
+        '-hot_score': ('-hot_score', '-id'),
+    }
+    default_ordering = '-created_at'
+
+    def get_ordering(self, request):
+        ordering = request.query_params.get(self.ordering_query_param, self.default_ordering)
+        return self.orderings.get(ordering, self.orderings[self.default_ordering])
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.ordering = self.get_ordering(request)
+        self.base_url = request.build_absolute_uri()
+        paginator = KeysetPaginator(queryset, self.ordering, self.get_page_size(request))
+        try:
+            self.page = paginator.page(request.query_params.get(self.cursor_query_param))
+        except InvalidCursor:
+            raise NotFound('Invalid cursor')
+        return self.page.object_list
+
+    def get_link(self, cursor):
+        if cursor is None:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_link(self.page.next_cursor),
+            'previous': self.get_link(self.page.previous_cursor),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,125 @@
+"""
+Per-request SQL accounting.
+
+QueryStatsMiddleware counts the statements each request runs, on every
+database alias, with their total time and the slowest few. The numbers are
+attached to the request as ``request.query_stats`` and logged at DEBUG on
+``comments.query_stats``. With QUERY_STATS_HEADERS (default: DEBUG) they are
+also sent back as response headers:
+
+    X-Query-Count: 6
+    X-Query-Time: 1.84ms
+    X-Query-Slowest: 0.61ms SELECT ... | 0.40ms SELECT ...
+    Server-Timing: db;dur=1.84;desc="6 queries"
+
+``query_budget()`` uses the same recorder to fail a test when a block of code
+runs more statements than a declared budget.
+"""
+import heapq
+import logging
+import re
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+SLOWEST = 3
+SQL_PREVIEW = 200
+
+
+class QueryRecorder:
+    """An execute wrapper tallying statement count, total time and the slowest statements."""
+
+    def __init__(self, slowest=SLOWEST, keep_all=False):
+        self.count = 0
+        self.duration = 0.0
+        self._slowest = []  # min-heap of (seconds, sequence, sql)
+        self._keep = slowest
+        self.statements = [] if keep_all else None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.duration += elapsed
+            entry = (elapsed, self.count, sql)
+            if len(self._slowest) < self._keep:
+                heapq.heappush(self._slowest, entry)
+            elif self._keep:
+                heapq.heappushpop(self._slowest, entry)
+            if self.statements is not None:
+                self.statements.append(sql)
+
+    @property
+    def slowest(self):
+        """[(milliseconds, sql)], slowest first."""
+        return [(elapsed * 1000, sql) for elapsed, _, sql in sorted(self._slowest, reverse=True)]
+
+    @property
+    def duration_ms(self):
+        return self.duration * 1000
+
+
+@contextmanager
+def record_queries(recorder=None):
+    """Record every statement run on any database alias, in this thread, inside the block."""
+    recorder = recorder or QueryRecorder()
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+        yield recorder
+
+
+def _header_sql(sql):
+    # One line of plain ASCII: headers can carry nothing else
+    sql = re.sub(r'\s+', ' ', sql).strip()
+    if len(sql) > SQL_PREVIEW:
+        sql = sql[:SQL_PREVIEW] + '...'
+    return sql.encode('ascii', 'backslashreplace').decode('ascii')
+
+
+class QueryStatsMiddleware:
+    """Measure the SQL behind each request; see the module docstring."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with record_queries() as stats:
+            request.query_stats = stats
+            response = self.get_response(request)
+        logger.debug(
+            '%s %s: %d queries in %.2fms', request.method, request.path, stats.count, stats.duration_ms,
+            extra={'query_count': stats.count, 'query_time_ms': stats.duration_ms},
+        )
+        if getattr(settings, 'QUERY_STATS_HEADERS', settings.DEBUG):
+            response['X-Query-Count'] = str(stats.count)
+            response['X-Query-Time'] = f'{stats.duration_ms:.2f}ms'
+            if stats.count:
+                response['X-Query-Slowest'] = ' | '.join(
+                    f'{ms:.2f}ms {_header_sql(sql)}' for ms, sql in stats.slowest
+                )
+            response['Server-Timing'] = f'db;dur={stats.duration_ms:.2f};desc="{stats.count} queries"'
+        return response
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def query_budget(limit, label='block'):
+    """Fail with QueryBudgetExceeded if the block runs more than ``limit`` statements."""
+    with record_queries(QueryRecorder(keep_all=True)) as recorder:
+        yield recorder
+    if recorder.count > limit:
+        listing = '\n'.join(f'{i}. {sql}' for i, sql in enumerate(recorder.statements, 1))
+        raise QueryBudgetExceeded(
+            f'{label} ran {recorder.count} queries, over its budget of {limit}:\n{listing}'
+        )
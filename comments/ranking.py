@@ -0,0 +1,55 @@
+"""
+"Hot" ranking: engagement decayed by age, stored per comment and per page.
+
+    hot = points / (age_in_hours + 2) ** HOT_GRAVITY
+
+A comment's points are its score plus HOT_REPLY_WEIGHT per reply (plus one,
+so a fresh comment outranks an old one with no activity). A page's points
+(Page.hot_points) are the scores of all its comments plus HOT_REPLY_WEIGHT per
+comment, plus one.
+
+Stored scores are recomputed whenever the points change (a vote, a reply) and
+re-decayed by ``manage.py decay_hot_scores``, which should run periodically.
+Anything older than HOT_HORIZON_DAYS is considered cold and stored as 0.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+GRAVITY = getattr(settings, 'HOT_GRAVITY', 1.8)
+REPLY_WEIGHT = getattr(settings, 'HOT_REPLY_WEIGHT', 2)
+HORIZON = timedelta(days=getattr(settings, 'HOT_HORIZON_DAYS', 7))
+
+
+def decay(created_at, now=None):
+    """Divisor applied to points for something created at ``created_at``."""
+    now = now or timezone.now()
+    age_hours = max(0.0, (now - created_at).total_seconds() / 3600)
+    return (age_hours + 2) ** GRAVITY
+
+
+def comment_points(score, reply_count):
+    return score + REPLY_WEIGHT * reply_count + 1
+
+
+def is_cold(created_at, now):
+    return now - created_at > HORIZON
+
+
+def hot_score(points, created_at, now=None):
+    now = now or timezone.now()
+    if is_cold(created_at, now):
+        return 0.0
+    return points / decay(created_at, now)
+
+
+def hot_expression(points, created_at, now=None):
+    """``hot_score`` as an expression, for an UPDATE whose points are themselves an expression."""
+    now = now or timezone.now()
+    if is_cold(created_at, now):
+        return models.Value(0.0)
+    return models.ExpressionWrapper(
+        points / models.Value(decay(created_at, now)), output_field=models.FloatField()
+    )
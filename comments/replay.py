@@ -0,0 +1,95 @@
+"""
+Per-page event sequence numbers and a replay buffer for reconnecting clients.
+
+Every event the outbox writes for a page group is stamped with the page's
+next sequence number (``seq`` in the client message) as it is written: the
+counter is a column on the page row (Page.live_seq), bumped inside the
+transaction making the change. Writers hold SQLite's write lock for the whole
+transaction, so sequence order is commit order; a send that is retried keeps
+its number, a write that rolls back gives its number back, and numbering
+survives the cache being flushed. Once committed the event is kept in a ring of the
+page's last LIVE_REPLAY_EVENTS events, for LIVE_REPLAY_TTL seconds, in the
+shared cache, so whichever worker a client reconnects to can replay it.
+
+A reconnecting client, or one that sees a gap in the numbers (an earlier event
+is waiting for a retry), sends the last ``seq`` it applied and gets only the
+events after it. If those are not all in the ring (too many, too old or
+evicted), it is told to ``resync``: reload the page.
+
+The page view renders the sequence number current *before* it reads the
+thread, so a client resuming from it may see an event twice but never misses
+one; events are idempotent for clients (comments are de-duplicated by id,
+updates carry state).
+"""
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from . import broadcasts
+from .models import Page
+
+REPLAY_TTL = getattr(settings, 'LIVE_REPLAY_TTL', 600)
+
+
+def ring_size():
+    return getattr(settings, 'LIVE_REPLAY_EVENTS', 200)
+
+
+def _event_key(page_id, seq):
+    return f'page_events:{page_id}:{seq % ring_size()}'
+
+
+def current(page_id):
+    """The sequence number of the page's latest event (0 before any)."""
+    return Page.objects.filter(pk=page_id).values_list('live_seq', flat=True).first() or 0
+
+
+def _next_seq(page_id):
+    """Bump the page's counter in the current transaction; None if the page is gone."""
+    pages = Page.objects.filter(pk=page_id)
+    if not pages.update(live_seq=F('live_seq') + 1):
+        return None
+    return pages.values_list('live_seq', flat=True).get()
+
+
+def sequence(group, event):
+    """Stamp a page group's event with the page's next sequence number; return (seq, event).
+
+    Events for other groups, or for a page that no longer exists, are returned
+    unchanged, with a seq of None.
+    """
+    page_id = broadcasts.group_page_id(group)
+    seq = None if page_id is None else _next_seq(page_id)
+    if seq is None:
+        return None, event
+    message = json.loads(event['text']) if 'text' in event else broadcasts.client_message(event)
+    message['seq'] = seq
+    return seq, {'type': event['type'], 'text': json.dumps(message)}
+
+
+def keep(group, seq, event):
+    """Add a sequenced event, once committed, to its page's replay ring."""
+    page_id = broadcasts.group_page_id(group)
+    cache.set(_event_key(page_id, seq), (seq, event['text']), timeout=REPLAY_TTL)
+
+
+def since(page_id, seq):
+    """The texts of the page's events after ``seq``, oldest first; None if they can't all be replayed."""
+    latest = current(page_id)
+    if seq == latest:
+        return []
+    if seq > latest or latest - seq > ring_size():
+        # Further back than the ring reaches, or ahead of the page (a client from another database)
+        return None
+    seqs = range(seq + 1, latest + 1)
+    keys = [_event_key(page_id, n) for n in seqs]
+    found = cache.get_many(keys)
+    texts = []
+    for n, key in zip(seqs, keys):
+        entry = found.get(key)
+        if entry is None or entry[0] != n:
+            return None
+        texts.append(entry[1])
+    return texts
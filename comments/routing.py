@@ -2,6 +2,7 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
-    re_path(r'ws/comments/(?P<page_id>\w+)/$', consumers.CommentConsumer.as_asgi()),
+    re_path(r'ws/comments/(?P<page_id>\d+)/$', consumers.CommentConsumer.as_asgi()),
     re_path(r'ws/notifications/$', consumers.NotificationConsumer.as_asgi()),
+    re_path(r'ws/live/$', consumers.LiveConsumer.as_asgi()),
 ]
\ No newline at end of file
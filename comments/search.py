@@ -0,0 +1,182 @@
+"""
+Full-text search over discussions and comments.
+
+On SQLite the text lives in an FTS5 table, ``comments_search`` (created by
+migration 0014), that triggers keep in sync with every write to Page and
+Comment, including soft deletes: a deleted comment simply has no row. Pages and
+comments share the table; a row's id encodes its source (``rowid = id * 2``
+for a page, ``id * 2 + 1`` for a comment).
+
+Ranking is bm25 with titles weighted above bodies. To keep latency flat for
+very common terms, only the SEARCH_CANDIDATES most recent matches are ranked:
+FTS5 can walk matches newest-first without touching the rest. Older matches
+are not returned at all, however relevant; a SearchPage says so with
+``capped``, which the API and the search page pass on. Words match
+whole; ``word*`` asks for a prefix match, which is fast for two- and
+three-letter prefixes (they have their own index) and slower for longer ones,
+since every matching term's postings must be merged.
+
+Other database backends fall back to a LIKE scan, newest first, so the
+feature degrades instead of failing.
+"""
+import re
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import Q
+from django.urls import reverse
+from django.utils.html import escape
+
+from .models import Comment, Page
+
+TABLE = 'comments_search'
+CANDIDATES = getattr(settings, 'SEARCH_CANDIDATES', 1000)
+TITLE_WEIGHT = 10.0
+SNIPPET_TOKENS = 24
+
+# Control characters can't occur in a search term, so they mark hits safely
+# through escape() and are then swapped for <mark> tags
+_OPEN, _CLOSE = '\x02', '\x03'
+
+# capped: the query matched more than CANDIDATES rows, so only the newest were ranked
+SearchPage = namedtuple('SearchPage', ['results', 'has_next', 'capped'], defaults=[False])
+
+def rebuild_index(using='default'):
+    """Refill the index from the Page and Comment tables; returns the number of rows indexed."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+        cursor.execute(f'INSERT INTO {TABLE}(rowid, title, body) SELECT id * 2, title, content FROM comments_page')
+        cursor.execute(
+            f"INSERT INTO {TABLE}(rowid, title, body)"
+            f" SELECT id * 2 + 1, '', content FROM comments_comment WHERE NOT is_deleted"
+        )
+        # Merge the index b-trees now rather than during later writes
+        cursor.execute(f"INSERT INTO {TABLE}({TABLE}) VALUES ('optimize')")
+        cursor.execute(f'SELECT COUNT(*) FROM {TABLE}')
+        return cursor.fetchone()[0]
+
+
+def match_expression(query):
+    """FTS5 query for free text: every word must match; ``word*`` matches as a prefix.
+
+    Quoting each word keeps FTS5 operators and punctuation in user input from
+    being parsed as query syntax.
+    """
+    terms = []
+    for word, star in re.findall(r'(\w+)(\*?)', query):
+        terms.append(f'"{word}"{star}')
+    return ' '.join(terms)
+
+
+def _marked_html(text):
+    return escape(text).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+def search(query, offset=0, limit=20):
+    """Ranked matches for ``query`` as a SearchPage of result dicts."""
+    if connection.vendor != 'sqlite':
+        return _search_like(query, offset, limit)
+    expression = match_expression(query)
+    if not expression:
+        return SearchPage([], False)
+
+    with connection.cursor() as cursor:
+        # Rank the newest candidates; bm25() only runs for rows the inner query returns.
+        # One extra is read to tell whether any match is older than the candidates
+        cursor.execute(
+            f'SELECT rowid, capped FROM ('
+            f'  SELECT rowid, score, COUNT(*) OVER () > %s AS capped, ROW_NUMBER() OVER (ORDER BY rowid DESC) AS n'
+            f'  FROM ('
+            f'    SELECT rowid, bm25({TABLE}, %s, 1.0) AS score FROM {TABLE}'
+            f'    WHERE {TABLE} MATCH %s ORDER BY rowid DESC LIMIT %s'
+            f'  )'
+            f') WHERE n <= %s ORDER BY score, rowid DESC LIMIT %s OFFSET %s',
+            [CANDIDATES, TITLE_WEIGHT, expression, CANDIDATES + 1, CANDIDATES, limit + 1, offset],
+        )
+        rows = cursor.fetchall()
+        rowids = [rowid for rowid, _ in rows]
+        has_next = len(rowids) > limit
+        rowids = rowids[:limit]
+        if rows:
+            capped = bool(rows[0][1])
+        else:
+            # Past the last result: check for older matches without ranking
+            cursor.execute(
+                f'SELECT 1 FROM {TABLE} WHERE {TABLE} MATCH %s ORDER BY rowid DESC LIMIT 1 OFFSET %s',
+                [expression, CANDIDATES],
+            )
+            capped = cursor.fetchone() is not None
+        if not rowids:
+            return SearchPage([], False, capped)
+
+        # Highlights only for the rows on this page
+        placeholders = ', '.join(['%s'] * len(rowids))
+        cursor.execute(
+            f'SELECT rowid, highlight({TABLE}, 0, %s, %s), snippet({TABLE}, 1, %s, %s, %s, %s)'
+            f' FROM {TABLE} WHERE {TABLE} MATCH %s AND rowid IN ({placeholders})',
+            [_OPEN, _CLOSE, _OPEN, _CLOSE, '…', SNIPPET_TOKENS, expression, *rowids],
+        )
+        marked = {rowid: (title, snippet) for rowid, title, snippet in cursor.fetchall()}
+
+    pages = Page.objects.in_bulk([rowid // 2 for rowid in rowids if rowid % 2 == 0])
+    comments = Comment.objects.select_related('author', 'page').in_bulk(
+        [rowid // 2 for rowid in rowids if rowid % 2 == 1]
+    )
+    results = []
+    for rowid in rowids:
+        source = comments.get(rowid // 2) if rowid % 2 else pages.get(rowid // 2)
+        if source is None:
+            continue
+        title, snippet = marked.get(rowid, ('', ''))
+        results.append(_result(source, _marked_html(title), _marked_html(snippet)))
+    return SearchPage(results, has_next, capped)
+
+
+def _result(source, title_html, snippet_html):
+    if isinstance(source, Page):
+        return {
+            'type': 'page',
+            'id': source.pk,
+            'page_id': source.pk,
+            'title': source.title,
+            'title_html': title_html or escape(source.title),
+            'snippet_html': snippet_html,
+            'author': None,
+            'created_at': source.created_at,
+            'url': reverse('comments:page_detail', args=[source.pk]),
+        }
+    return {
+        'type': 'comment',
+        'id': source.pk,
+        'page_id': source.page_id,
+        'title': source.page.title,
+        'title_html': escape(source.page.title),
+        'snippet_html': snippet_html,
+        'author': source.author.username,
+        'created_at': source.created_at,
+        'url': reverse('comments:page_detail', args=[source.page_id]),
+    }
+
+
+def _search_like(query, offset, limit):
+    words = re.findall(r'\w+', query)
+    if not words:
+        return SearchPage([], False)
+    pages = Page.objects.all()
+    comments = Comment.objects.filter(is_deleted=False).select_related('author', 'page')
+    for word in words:
+        pages = pages.filter(Q(title__icontains=word) | Q(content__icontains=word))
+        comments = comments.filter(content__icontains=word)
+    # Newest first across both sources
+    needed = offset + limit + 1
+    matches = sorted(
+        [*pages.order_by('-created_at')[:needed], *comments.order_by('-created_at')[:needed]],
+        key=lambda source: source.created_at, reverse=True,
+    )
+    window = matches[offset:offset + limit + 1]
+    results = [
+        _result(source, '', escape(source.content[:200]))
+        for source in window[:limit]
+    ]
+    return SearchPage(results, len(window) > limit)
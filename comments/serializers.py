@@ -1,6 +1,9 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from django.db import models
 from .models import Page, Comment, Vote
+from .threads import attach_reply_counts, walk
+from .viewer_state import attach_user_votes
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -9,11 +12,27 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['id', 'username', 'date_joined']
 
 
+def _request_user(context):
+    request = context.get('request')
+    return request.user if request else None
+
+
+class CommentListSerializer(serializers.ListSerializer):
+    """Loads the viewer's votes and the reply counts for every comment in the list (and nested replies).
+
+    One query each, for just the rows being serialized.
+    """
+
+    def to_representation(self, data):
+        comments = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        attach_user_votes(walk(comments), _request_user(self.context))
+        attach_reply_counts(comments)
+        return super().to_representation(comments)
+
+
 class CommentSerializer(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
-    upvotes = serializers.IntegerField(read_only=True)
-    downvotes = serializers.IntegerField(read_only=True)
-    net_votes = serializers.IntegerField(read_only=True)
+    net_votes = serializers.IntegerField(source='score', read_only=True)
     user_vote = serializers.SerializerMethodField()
     replies_count = serializers.SerializerMethodField()
     
@@ -21,23 +40,44 @@ class CommentSerializer(serializers.ModelSerializer):
         model = Comment
         fields = ['id', 'page', 'author', 'parent', 'content', 'created_at', 
                   'updated_at', 'is_deleted', 'upvotes', 'downvotes', 'net_votes',
-                  'user_vote', 'replies_count']
-        read_only_fields = ['id', 'author', 'created_at', 'updated_at', 'is_deleted']
+                  'user_vote', 'replies_count', 'depth', 'hot_score']
+        read_only_fields = ['id', 'author', 'created_at', 'updated_at', 'is_deleted',
+                            'upvotes', 'downvotes', 'depth', 'hot_score']
+        list_serializer_class = CommentListSerializer
     
     def get_user_vote(self, obj):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            try:
-                vote = Vote.objects.get(user=request.user, comment=obj)
-                return vote.vote_type
-            except Vote.DoesNotExist:
-                return None
-        return None
+        if not hasattr(obj, 'user_vote'):
+            # Single object: batch-load votes for it and any pre-linked replies
+            attach_user_votes(walk([obj]), _request_user(self.context))
+        return obj.user_vote
     
     def get_replies_count(self, obj):
+        # Nodes linked by comments.threads carry their replies already
+        if hasattr(obj, 'children'):
+            return len(obj.children) + obj.hidden_replies
+        if hasattr(obj, 'visible_replies'):
+            return obj.visible_replies
         return obj.replies.filter(is_deleted=False).count()
 
 
+class ThreadedCommentSerializer(CommentSerializer):
+    """Nested comment tree built from nodes pre-linked by comments.threads."""
+    replies = serializers.SerializerMethodField()
+
+    class Meta(CommentSerializer.Meta):
+        fields = CommentSerializer.Meta.fields + ['replies']
+
+    def get_replies(self, obj):
+        return ThreadedCommentSerializer(obj.children, many=True, context=self.context).data
+
+
+class CommentUpdateSerializer(CommentSerializer):
+    """Edits change only the content: a comment's place in a thread (page, parent) is fixed at creation."""
+
+    class Meta(CommentSerializer.Meta):
+        read_only_fields = CommentSerializer.Meta.read_only_fields + ['page', 'parent']
+
+
 class CommentCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comment
@@ -48,20 +88,37 @@ class CommentCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Cannot reply to a deleted comment.")
         return value
 
+    def validate(self, attrs):
+        # A reply inherits its parent's path, so it must live on the parent's page
+        parent = attrs.get('parent')
+        if parent and parent.page_id != attrs['page'].pk:
+            raise serializers.ValidationError({'parent': "Cannot reply to a comment on another page."})
+        return attrs
+
 
 class PageSerializer(serializers.ModelSerializer):
-    comments_count = serializers.SerializerMethodField()
+    # Stored on Page (all visible comments, any depth) rather than counted per row
+    comments_count = serializers.IntegerField(source='comment_count', read_only=True)
     
     class Meta:
         model = Page
-        fields = ['id', 'title', 'content', 'created_at', 'comments_count']
-    
-    def get_comments_count(self, obj):
-        return obj.comments.filter(is_deleted=False, parent__isnull=True).count()
+        fields = ['id', 'title', 'content', 'created_at', 'comments_count', 'last_activity_at', 'hot_score']
 
 
 class VoteSerializer(serializers.ModelSerializer):
     class Meta:
         model = Vote
         fields = ['id', 'comment', 'vote_type', 'voted_at']
-        read_only_fields = ['id', 'voted_at']
\ No newline at end of file
+        read_only_fields = ['id', 'voted_at']
+
+class SearchResultSerializer(serializers.Serializer):
+    """A comments.search result; the *_html fields are escaped text with <mark>ed matches."""
+    type = serializers.CharField()
+    id = serializers.IntegerField()
+    page_id = serializers.IntegerField()
+    title = serializers.CharField()
+    title_html = serializers.CharField()
+    snippet_html = serializers.CharField()
+    author = serializers.CharField(allow_null=True)
+    created_at = serializers.DateTimeField()
+    url = serializers.CharField()
@@ -0,0 +1,156 @@
+"""
+Thread assembly: load a page's whole comment tree in one query and link it in memory.
+
+Templates and serializers read the pre-linked ``comment.children`` list instead of
+issuing a ``parent=...`` query per node.
+"""
+from operator import attrgetter
+
+from django.db.models import Count, Q
+
+from .models import Comment
+
+
+# Newest top-level comments first, replies in conversation order
+DEFAULT_ORDERING = ('-created_at', 'created_at')
+# Shown instead of a soft-deleted comment's text where the comment must still appear
+DELETED_PLACEHOLDER = '[This comment was deleted]'
+
+
+def _sort_nodes(nodes, field):
+    reverse = field.startswith('-')
+    nodes.sort(key=attrgetter(field.lstrip('-'), 'pk'), reverse=reverse)
+
+
+def build_tree(comments, max_depth=None, ordering=DEFAULT_ORDERING, root_id=None):
+    """Link already-fetched comments into a tree and return the root nodes.
+
+    Sorting happens here, so callers fetch with ``.order_by()`` to spare the
+    database a sort.
+
+    Every node gets ``children`` (list) and ``hidden_replies`` (visible replies
+    cut off by ``max_depth``, counted from the roots). ``ordering`` is one
+    field per level; the last entry applies to all deeper levels. Nodes whose
+    parent is not in ``comments`` are dropped; the roots are the comments whose
+    parent is ``root_id``.
+
+    Soft-deleted comments stay in the tree while they have visible replies, so
+    those replies keep their place, with their content replaced by
+    DELETED_PLACEHOLDER; without any they are dropped.
+    """
+    by_parent = {}
+    for comment in comments:
+        comment.children = []
+        comment.hidden_replies = 0
+        by_parent.setdefault(comment.parent_id, []).append(comment)
+
+    roots = by_parent.get(root_id, [])
+    linked = []
+    level, depth = roots, 0
+    while level:
+        _sort_nodes(level, ordering[min(depth, len(ordering) - 1)])
+        linked.extend(level)
+        next_level = []
+        for node in level:
+            replies = by_parent.get(node.pk, [])
+            if max_depth is not None and depth >= max_depth:
+                node.hidden_replies = sum(not reply.is_deleted for reply in replies)
+                continue
+            node.children = replies
+            next_level.extend(replies)
+        level, depth = next_level, depth + 1
+
+    # Deepest first, so a node's children are settled before the node is judged
+    for node in reversed(linked):
+        node.children = [child for child in node.children if _shown(child)]
+        if node.is_deleted:
+            node.content = DELETED_PLACEHOLDER
+    return [root for root in roots if _shown(root)]
+
+
+def _shown(node):
+    return not node.is_deleted or bool(node.children) or node.hidden_replies > 0
+
+
+def load_thread(page, max_depth=None, ordering=DEFAULT_ORDERING):
+    """Fetch the comments on ``page`` with their authors in one query and return the root nodes.
+
+    Deleted top-level comments are left out, as in the paginated listings.
+    """
+    comments = list(
+        Comment.objects.filter(Q(is_deleted=False) | Q(parent__isnull=False), page=page)
+        .select_related('author').order_by()
+    )
+    return build_tree(comments, max_depth=max_depth, ordering=ordering)
+
+
+def link_replies(roots, max_depth=None, ordering=DEFAULT_ORDERING):
+    """Fetch the replies under an already-fetched list of top-level comments and link them.
+
+    Used with a paginated page of roots: one query OR-ing the roots' path ranges
+    reads only the replies that will be shown. Returns the linked roots.
+    """
+    roots = list(roots)
+    if not roots:
+        return roots
+    ranges = Q()
+    for root in roots:
+        ranges |= Comment.subtree_filter(root.path)
+    replies = Comment.objects.filter(ranges, parent__isnull=False).select_related('author').order_by()
+    if max_depth is not None:
+        replies = replies.filter(depth__lte=max_depth + 1)
+    return build_tree(roots + list(replies), max_depth=max_depth, ordering=ordering)
+
+
+def load_subtree(comment, max_depth=None, ordering=('created_at',)):
+    """Fetch ``comment`` and its descendants with one range query on the path index.
+
+    Returns the linked ``comment`` node (a fresh instance).
+    """
+    comments = Comment.objects.filter(Comment.subtree_filter(comment.path)).select_related('author').order_by()
+    if max_depth is not None:
+        # One extra level so the cut-off nodes know how many replies they hide
+        comments = comments.filter(depth__lte=comment.depth + max_depth + 1)
+    roots = build_tree(list(comments), max_depth=max_depth, ordering=ordering, root_id=comment.parent_id)
+    return roots[0] if roots else None
+
+
+def load_ancestors(comment):
+    """Fetch ``comment``'s ancestors, root first, by primary key in one query.
+
+    Deleted ancestors stay in the chain, so it still leads to the root, but
+    their content is replaced with DELETED_PLACEHOLDER.
+    """
+    ancestors = list(
+        Comment.objects.filter(pk__in=comment.ancestor_ids()).select_related('author').order_by('path')
+    )
+    for ancestor in ancestors:
+        if ancestor.is_deleted:
+            ancestor.content = DELETED_PLACEHOLDER
+    return ancestors
+
+
+def attach_reply_counts(comments):
+    """Set ``comment.visible_replies`` (undeleted direct replies) on every comment, in one query.
+
+    Nodes linked by build_tree() already know their replies and are skipped,
+    as are comments that carry the count already.
+    """
+    pending = [c for c in comments if not hasattr(c, 'children') and not hasattr(c, 'visible_replies')]
+    if not pending:
+        return
+    counts = dict(
+        Comment.objects.filter(parent_id__in=[comment.pk for comment in pending], is_deleted=False)
+        .order_by().values('parent_id').annotate(count=Count('id')).values_list('parent_id', 'count')
+    )
+    for comment in pending:
+        comment.visible_replies = counts.get(comment.pk, 0)
+
+
+def walk(nodes):
+    """Yield every node of a linked tree, depth-first."""
+    stack = list(reversed(nodes))
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(getattr(node, 'children', ())))
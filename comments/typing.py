@@ -0,0 +1,116 @@
+"""
+Server-side aggregation of typing indicators.
+
+Instead of re-broadcasting every ``typing`` frame to the whole page group
+(typists x viewers messages), consumers record each user's state here and one
+task per page sends a single "who is typing" snapshot every
+TYPING_BROADCAST_INTERVAL seconds, only when the set changed. Typists expire
+after TYPING_TTL seconds without a fresh frame, and a user's repeated frames
+are rate-limited to one per TYPING_MIN_FRAME_INTERVAL.
+
+State is per process: with several workers each one publishes the typists it
+sees, tagged with ``source`` so clients can merge them.
+"""
+import asyncio
+import os
+import time
+import uuid
+
+from django.conf import settings
+
+from . import metrics
+from .broadcasts import encode, page_group
+
+# Identifies this process's snapshots when several workers serve the same page
+SOURCE = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+class PageTypists:
+    def __init__(self):
+        self.expires = {}       # username -> monotonic expiry
+        self.last_frame = {}    # username -> monotonic time of last accepted frame
+        self.last_sent = ()
+        self.listeners = 0
+        self.task = None
+
+
+class TypingTracker:
+    def __init__(self, interval=None, ttl=None, min_frame_interval=None, clock=time.monotonic):
+        self.interval = interval if interval is not None else getattr(settings, 'TYPING_BROADCAST_INTERVAL', 0.3)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'TYPING_TTL', 3.0)
+        self.min_frame_interval = (
+            min_frame_interval if min_frame_interval is not None
+            else getattr(settings, 'TYPING_MIN_FRAME_INTERVAL', 0.5)
+        )
+        self.clock = clock
+        self.pages = {}
+
+    def _page(self, page_id):
+        return self.pages.setdefault(page_id, PageTypists())
+
+    def join(self, page_id):
+        self._page(page_id).listeners += 1
+
+    def leave(self, page_id, username=None):
+        page = self._page(page_id)
+        page.listeners = max(0, page.listeners - 1)
+        if username:
+            self.update(page_id, username, False)
+
+    def update(self, page_id, username, is_typing):
+        """Record a typing frame; returns False if it was dropped as redundant."""
+        page = self._page(page_id)
+        now = self.clock()
+        if not is_typing:
+            page.last_frame.pop(username, None)
+            return page.expires.pop(username, None) is not None
+        last = page.last_frame.get(username)
+        if last is not None and username in page.expires and now - last < self.min_frame_interval:
+            return False
+        page.last_frame[username] = now
+        page.expires[username] = now + self.ttl
+        return True
+
+    def snapshot(self, page_id):
+        """Prune stale typists and return the sorted typist tuple if it changed since the last call, else None."""
+        page = self._page(page_id)
+        now = self.clock()
+        for username, expires in list(page.expires.items()):
+            if expires <= now:
+                del page.expires[username]
+                page.last_frame.pop(username, None)
+        current = tuple(sorted(page.expires))
+        if current == page.last_sent:
+            return None
+        page.last_sent = current
+        return current
+
+    def is_idle(self, page_id):
+        page = self._page(page_id)
+        return page.listeners == 0 and not page.expires and not page.last_sent
+
+    def event(self, page_id, users):
+        return encode({'type': 'user_typing', 'page': page_id, 'users': list(users), 'source': SOURCE})
+
+    async def run(self, page_id, channel_layer):
+        """Publish snapshots for one page until nobody is connected and nobody is typing."""
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                users = self.snapshot(page_id)
+                if users is not None:
+                    await metrics.group_send(channel_layer, page_group(page_id), self.event(page_id, users))
+                if self.is_idle(page_id):
+                    break
+        finally:
+            page = self.pages.get(page_id)
+            if page is not None and page.listeners == 0 and not page.expires:
+                del self.pages[page_id]
+
+    def ensure_running(self, page_id, channel_layer):
+        page = self._page(page_id)
+        if page.task is None or page.task.done():
+            page.task = asyncio.get_running_loop().create_task(self.run(page_id, channel_layer))
+
+
+tracker = TypingTracker()
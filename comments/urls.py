@@ -12,6 +12,7 @@ urlpatterns = [
     path('comment/<int:comment_id>/vote/', views.vote_comment, name='vote_comment'),
     path('comment/<int:comment_id>/edit/', views.edit_comment, name='edit_comment'),
     path('comment/<int:comment_id>/delete/', views.delete_comment, name='delete_comment'),
+    path('search/', views.search_results, name='search'),
     path('signup/', views.signup, name='signup'),
     path('create/', views.create_discussion, name='create_discussion'), 
 ]
@@ -0,0 +1,29 @@
+"""
+Per-viewer comment state (the current user's own vote), loaded in one query for
+a whole set of comments instead of one lookup per comment.
+"""
+from .models import Vote
+
+
+def load_user_votes(user, comment_ids):
+    """Map comment id -> 'up'/'down' for ``user``'s votes among ``comment_ids``, in one query."""
+    if user is None or not user.is_authenticated or not comment_ids:
+        return {}
+    return dict(
+        Vote.objects.filter(user=user, comment_id__in=comment_ids).values_list('comment_id', 'vote_type')
+    )
+
+
+def attach_user_votes(comments, user):
+    """Set ``comment.user_vote`` ('up', 'down' or None) on every comment for ``user``.
+
+    Comments that already carry ``user_vote`` are left alone, so calling this
+    again on an overlapping set costs nothing.
+    """
+    pending = [comment for comment in comments if not hasattr(comment, 'user_vote')]
+    if not pending:
+        return
+
+    votes = load_user_votes(user, [comment.pk for comment in pending])
+    for comment in pending:
+        comment.user_vote = votes.get(comment.pk)
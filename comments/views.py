@@ -4,91 +4,133 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponseRedirect, JsonResponse
 from django.urls import reverse
-from django.views.decorators.http import require_POST
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import condition, require_POST
 from django.core.cache import cache
-from django.core.paginator import Paginator
 from django.conf import settings
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from django.db.models import Count, Q
+from django.db import transaction
 
 from .models import Page, Comment, Vote
 from .forms import CommentForm, CustomUserCreationForm
+from . import fragment_cache, metrics, search
+from .broadcasts import publish_comment_change, publish_new_comment
+from .conditional import page_detail_etag, page_live_seq, page_marker
+from .pagination import KeysetPage, KeysetPaginator
+from .threads import link_replies, walk
+from .viewer_state import load_user_votes
+from .votes import cast_vote, normalize_vote_type
 
 # Get cache timeout from settings (add this to settings.py if not exists)
 CACHE_TTL = getattr(settings, 'CACHE_TTL', 900)  # 15 minutes default
+THREAD_MAX_DEPTH = getattr(settings, 'COMMENT_THREAD_MAX_DEPTH', None)  # None = unlimited
+COMMENTS_PER_PAGE = 10
+SEARCH_RESULTS_PER_PAGE = 20
 
+# ?sort= options for top-level comments on a discussion; the trailing id keeps keyset order total
+COMMENT_SORTS = {
+    'new': ('-created_at', '-id'),
+    'top': ('-score', '-id'),
+    'hot': ('-hot_score', '-id'),
+}
 
-def homepage(request):
-    """Display the list of pages/discussions"""
-    pages = Page.objects.all().order_by('-created_at')
-    
-    # Annotate with comment count
-    pages = pages.annotate(
-        comment_count=Count('comments', filter=Q(comments__is_deleted=False))
-    )
-    
-    return render(request, 'comments/homepage.html', {'pages': pages})
-
-
-def annotate_comments(comments, user):
-    """Helper to add user-specific info and permissions to comment objects.
+# ?sort= options for the homepage's discussion list
+PAGE_SORTS = {
+    'new': ('-created_at', '-id'),
+    'hot': ('-hot_score', '-id'),
+}
 
-    NOTE: do NOT assign to model @property attributes like upvote_count/downvote_count/score,
-    instead rely on the model properties and only attach temporary attributes used by templates.
-    """
-    annotated = []
-    for comment in comments:
-        # user vote status (safe to attach)
-        if user.is_authenticated:
-            try:
-                user_vote = comment.votes.get(user=user)
-                comment.user_vote = user_vote.vote_type
-            except Vote.DoesNotExist:
-                comment.user_vote = None
-        else:
-            comment.user_vote = None
 
-        # permissions (safe to attach)
-        comment.can_edit = comment.can_be_edited_by(user)
-        comment.can_delete = comment.can_be_deleted_by(user)
+def homepage(request):
+    """Display the list of pages/discussions"""
+    sort = request.GET.get('sort')
+    if sort not in PAGE_SORTS:
+        sort = 'new'
 
-        # do not assign to comment.upvote_count / comment.downvote_count / comment.score
-        # those are model @property attributes and should be accessed read-only in templates
+    def render_listing():
+        # Comment counts and activity times are stored on Page: one query for the whole list
+        pages = Page.objects.order_by(*PAGE_SORTS[sort])
+        return render_to_string('comments/page_list.html', {'pages': pages})
 
-        annotated.append(comment)
+    listing = fragment_cache.get_or_render(fragment_cache.homepage_key(sort), render_listing, counted=False)
+    return render(request, 'comments/homepage.html', {'page_list_html': mark_safe(listing), 'sort': sort})
 
-    return annotated
 
+def comment_page_context(request, page):
+    """Template context for one keyset page of a discussion's top-level comments.
 
+    The thread HTML comes from the fragment cache, keyed by the page's thread
+    version; on a miss only the requested top-level comments and their replies
+    are read and rendered. Viewer state is looked up separately so the cached
+    fragment is shared by every user.
+    """
+    sort = request.GET.get('sort')
+    if sort not in COMMENT_SORTS:
+        sort = 'new'
+    ordering = COMMENT_SORTS[sort]
+    top_level_comments = Comment.objects.filter(
+        page=page,
+        parent__isnull=True,
+        is_deleted=False
+    ).select_related('author')
+    paginator = KeysetPaginator(top_level_comments, ordering, COMMENTS_PER_PAGE)
+    # Keyed by the page actually served: a malformed cursor shares the first page's entry
+    cursor = paginator.normalize(request.GET.get('cursor'))
+    # Read before the thread: a client resuming from it may see an event twice, never miss one
+    live_seq = page_live_seq(request, page.pk)
+
+    def render_thread():
+        page_obj = paginator.get_page(cursor)
+        roots = link_replies(page_obj.object_list, max_depth=THREAD_MAX_DEPTH, ordering=(ordering[0], 'created_at'))
+
+        return {
+            'html': render_to_string('comments/comment_thread.html', {
+                'comments': roots,
+                'csrf_placeholder': fragment_cache.CSRF_PLACEHOLDER,
+            }),
+            'root_ids': [comment.pk for comment in roots],
+            'comment_ids': [comment.pk for comment in walk(roots)],
+            'next_cursor': page_obj.next_cursor,
+            'previous_cursor': page_obj.previous_cursor,
+        }
+
+    # Read with the ETag's marker; the stored count spares a miss a COUNT over the whole discussion
+    marker = page_marker(request, page.pk)
+    version = marker.thread_version if marker else 0
+    key = fragment_cache.fragment_key(page.pk, version, sort, cursor, THREAD_MAX_DEPTH)
+    thread = fragment_cache.get_or_render(key, render_thread)
+
+    # Viewer-specific bits, applied on top of the shared fragment
+    html = thread['html'].replace(fragment_cache.CSRF_PLACEHOLDER, get_token(request))
+    viewer_votes = load_user_votes(request.user, thread['comment_ids'])
+
+    page_obj = KeysetPage(thread['root_ids'], thread['next_cursor'], thread['previous_cursor'])
+    return {
+        'thread_html': mark_safe(html),
+        'page_obj': page_obj,
+        'sort': sort,
+        'comment_count': marker.comment_count if marker else page.comment_count,
+        'viewer_votes': viewer_votes,
+        'live_seq': live_seq,
+    }
+
+
+@condition(etag_func=page_detail_etag)
 def page_detail(request, page_id):
     """Display a page/discussion with its comments"""
     # Try to get page from cache first
     cache_key = f'page_{page_id}'
     page = cache.get(cache_key)
+    metrics.cache_lookup('page', page is not None)
     
     if not page:
         page = get_object_or_404(Page, pk=page_id)
         cache.set(cache_key, page, timeout=CACHE_TTL)
     
-    # Get top-level comments (don't cache the QuerySet itself, causes issues)
-    top_level_comments = Comment.objects.filter(
-        page=page, 
-        parent__isnull=True,
-        is_deleted=False
-    ).select_related('author').prefetch_related('votes').order_by('-created_at')
-    
-    # Annotate comments with vote data and permissions
-    annotated_comments = annotate_comments(top_level_comments, request.user)
-    
-    # Pagination
-    paginator = Paginator(annotated_comments, 10)  # 10 comments per page
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
-    
     # Handle comment submission
     if request.method == 'POST' and request.user.is_authenticated:
-        form = CommentForm(request.POST)
+        form = CommentForm(request.POST, page=page)
         if form.is_valid():
             comment = form.save(commit=False)
             comment.author = request.user
@@ -99,45 +141,16 @@ def page_detail(request, page_id):
             if parent_comment:
                 comment.parent = parent_comment
             
-            comment.save()
+            # Live viewers get the rendered comment instead of reloading; the
+            # event is stored with the comment and sent after commit
+            with transaction.atomic():
+                comment.save()
+                publish_new_comment(comment)
+            metrics.COMMENT_WRITES.labels('created', 'html').inc()
             
             # Invalidate cache
             cache.delete(f'page_{page_id}')
-            
-            # Send WebSocket notification
-            try:
-                channel_layer = get_channel_layer()
-                
-                # Notify the page room
-                async_to_sync(channel_layer.group_send)(
-                    f'comments_page_{page_id}',
-                    {
-                        'type': 'comment_message',
-                        'comment': {
-                            'id': comment.id,
-                            'author': comment.author.username,
-                            'content': comment.content,
-                            'created_at': comment.created_at.isoformat(),
-                            'parent_id': comment.parent_id
-                        }
-                    }
-                )
-                
-                # If it's a reply, notify the parent comment author
-                if comment.parent and comment.parent.author != request.user:
-                    async_to_sync(channel_layer.group_send)(
-                        f'notifications_{comment.parent.author.id}',
-                        {
-                            'type': 'notification_message',
-                            'message': f'{request.user.username} replied to your comment',
-                            'comment_id': comment.id,
-                            'page_id': page_id
-                        }
-                    )
-            except Exception as e:
-                # WebSocket failed but comment was saved
-                print(f"WebSocket error: {e}")
-            
+
             if parent_comment:
                 messages.success(request, 'Reply added successfully!')
             else:
@@ -149,9 +162,26 @@ def page_detail(request, page_id):
     
     return render(request, 'comments/page_detail.html', {
         'page': page,
-        'comments': page_obj,
         'comment_form': form,
-        'page_obj': page_obj
+        **comment_page_context(request, page),
+    })
+
+
+def search_results(request):
+    """Full-text search over discussions and comments (?q=, ?page=)"""
+    query = request.GET.get('q', '').strip()
+    try:
+        page_number = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        page_number = 1
+    found = search.search(query, offset=(page_number - 1) * SEARCH_RESULTS_PER_PAGE, limit=SEARCH_RESULTS_PER_PAGE)
+    return render(request, 'comments/search.html', {
+        'query': query,
+        'results': found.results,
+        'page_number': page_number,
+        'has_next': found.has_next,
+        'capped': found.capped,
+        'candidates': search.CANDIDATES,
     })
 
 
@@ -174,7 +204,7 @@ def add_comment(request, page_id):
     page = get_object_or_404(Page, id=page_id)
 
     if request.method == 'POST':
-        form = CommentForm(request.POST)
+        form = CommentForm(request.POST, page=page)
 
         if form.is_valid():
             comment = form.save(commit=False)
@@ -189,20 +219,19 @@ def add_comment(request, page_id):
             else:
                 messages.success(request, 'Comment added successfully!')
 
-            comment.save()
+            with transaction.atomic():
+                comment.save()
+                publish_new_comment(comment)
+            metrics.COMMENT_WRITES.labels('created', 'html').inc()
             return redirect('comments:page_detail', page_id=page_id)
 
         else:
             # Re-fetch comments with permissions for rendering
-            comments = Comment.objects.filter(page=page, parent=None).order_by('-created_at')
-            for comment in comments:
-                annotate_comments(comment, request.user)
-                
             return render(request, 'comments/page_detail.html', {
                 'page': page,
-                'comments': comments,
                 'comment_form': form,
                 'parent_id': request.POST.get('parent_id'),
+                **comment_page_context(request, page),
             })
 
     return redirect('comments:page_detail', page_id=page_id)
@@ -217,40 +246,28 @@ def vote_comment(request, comment_id):
     comment = get_object_or_404(Comment, id=comment_id)
     vote_type = request.POST.get('vote_type')
 
-    # Validate vote_type
-    if vote_type not in ['up', 'down']:
-        messages.error(request, 'Invalid vote type.')
-        return redirect('comments:page_detail', page_id=comment.page.id)
-
     try:
-        existing_vote = Vote.objects.get(user=request.user, comment=comment)
-
-        if existing_vote.vote_type == vote_type:
-            existing_vote.delete()
-            action = 'removed'
-        else:
-            existing_vote.vote_type = vote_type
-            existing_vote.save()
-            action = 'changed'
-
-    except Vote.DoesNotExist:
-        Vote.objects.create(user=request.user, comment=comment, vote_type=vote_type)
-        action = 'added'
+        result = cast_vote(request.user, comment, vote_type)
+    except ValueError:
+        messages.error(request, 'Invalid vote type.')
+        return redirect('comments:page_detail', page_id=comment.page_id)
+    action = result.action
+    metrics.VOTES.labels(action, 'html').inc()
 
     # Handle AJAX (optional)
     if request.headers.get('x-requested-with') == 'XMLHttpRequest':
         return JsonResponse({
             'success': True,
             'action': action,
-            'upvote_count': comment.upvote_count,
-            'downvote_count': comment.downvote_count,
-            'score': comment.score,
-            'user_vote': comment.get_user_vote(request.user)
+            'upvote_count': result.upvotes,
+            'downvote_count': result.downvotes,
+            'score': result.score,
+            'user_vote': result.vote_type
         })
 
     # Normal request
-    messages.success(request, f"Vote {action}: {vote_type}")
-    return redirect('comments:page_detail', page_id=comment.page.id)
+    messages.success(request, f"Vote {action}: {normalize_vote_type(vote_type)}")
+    return redirect('comments:page_detail', page_id=comment.page_id)
 
 @login_required
 def edit_comment(request, comment_id):
@@ -264,7 +281,10 @@ def edit_comment(request, comment_id):
     if request.method == 'POST':
         form = CommentForm(request.POST, instance=comment)
         if form.is_valid():
-            form.save()
+            with transaction.atomic():
+                form.save()
+                publish_comment_change(comment)
+            metrics.COMMENT_WRITES.labels('edited', 'html').inc()
             cache.delete(f'page_{comment.page.id}')
             messages.success(request, 'Comment updated successfully!')
             return redirect('comments:page_detail', page_id=comment.page.id)
@@ -283,7 +303,10 @@ def delete_comment(request, comment_id):
         messages.error(request, "You can't delete this comment.")
     else:
         comment.is_deleted = True
-        comment.save()
+        with transaction.atomic():
+            comment.save()
+            publish_comment_change(comment)
+        metrics.COMMENT_WRITES.labels('deleted', 'html').inc()
         cache.delete(f'page_{comment.page.id}')
         messages.success(request, "Comment deleted.")
 
@@ -0,0 +1,80 @@
+"""
+Vote toggling shared by the HTML view and the API.
+
+Each step is a single conditional statement whose row count says what happened
+(insert guarded by the unique (user, comment) constraint, delete-if-same,
+update-if-different), so concurrent clicks can neither violate the constraint
+nor drift the stored counters. The vote change and the counter update commit
+in one transaction, together with the (coalesced) vote_update event.
+"""
+import random
+import time
+from collections import namedtuple
+
+from django.db import IntegrityError, OperationalError, transaction
+
+from .broadcasts import publish_vote_update
+from .models import Vote
+
+VoteResult = namedtuple('VoteResult', ['action', 'vote_type', 'upvotes', 'downvotes', 'score'])
+
+# Accepted spellings of a vote; the API historically sent 1/-1
+VOTE_ALIASES = {
+    'up': 'up', 'down': 'down',
+    1: 'up', -1: 'down',
+    '1': 'up', '-1': 'down',
+}
+
+OPPOSITE = {'up': 'down', 'down': 'up'}
+
+# SQLite reports lock contention as OperationalError instead of waiting forever
+LOCK_RETRIES = 20
+LOCK_BACKOFF = 0.01
+
+
+def normalize_vote_type(value):
+    """Return 'up' or 'down' for any accepted spelling; raise ValueError otherwise."""
+    try:
+        return VOTE_ALIASES[value]
+    except (KeyError, TypeError):
+        raise ValueError(f'Invalid vote type: {value!r}')
+
+
+def _toggle(user, comment, vote_type):
+    votes = Vote.objects.filter(user=user, comment=comment)
+    while True:
+        try:
+            with transaction.atomic():
+                Vote.objects.create(user=user, comment=comment, vote_type=vote_type)
+            return 'added', None, vote_type
+        except IntegrityError:
+            pass
+        # A vote exists: clicking the same button again removes it...
+        if votes.filter(vote_type=vote_type).delete()[0]:
+            return 'removed', vote_type, None
+        # ...and the other button switches it
+        if votes.exclude(vote_type=vote_type).update(vote_type=vote_type):
+            return 'changed', OPPOSITE[vote_type], vote_type
+        # The row vanished between statements (a concurrent removal); start over
+
+
+def cast_vote(user, comment, vote_type):
+    """Add, switch or remove ``user``'s vote on ``comment`` and return a VoteResult.
+
+    ``vote_type`` may be 'up'/'down' or 1/-1. The returned counts come from the
+    stored counters, not from COUNT queries.
+    """
+    vote_type = normalize_vote_type(vote_type)
+    for attempt in range(LOCK_RETRIES):
+        try:
+            with transaction.atomic():
+                action, old_type, new_type = _toggle(user, comment, vote_type)
+                comment.adjust_vote_counts(*Vote.counter_delta(old_type, new_type))
+                publish_vote_update(comment)
+            break
+        except OperationalError as e:
+            if 'locked' not in str(e) or attempt == LOCK_RETRIES - 1:
+                raise
+            # Jittered backoff so contending writers don't retry in lockstep
+            time.sleep(random.uniform(0, LOCK_BACKOFF * (attempt + 1)))
+    return VoteResult(action, new_type, comment.upvotes, comment.downvotes, comment.score)